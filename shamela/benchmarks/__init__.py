@@ -0,0 +1,226 @@
+"""
+Offline benchmarks of the crawler hot paths, over responses recorded in the HTTP cache and stored pages.
+Run the suite with `python -m shamela.benchmarks`, and each benchmark module with
+`python -m shamela.benchmarks.<name>`.
+"""
+
+import gzip
+import pickle
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any
+
+from scrapy.crawler import Crawler
+from scrapy.http import Headers, Request, Response
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import BaseSettings, Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from scrapy.utils.request import RequestFingerprinter
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from w3lib.http import headers_raw_to_dict
+
+from shamela.db import Page, create_db_engine
+from shamela.httpcache import SqliteCacheStorage, cache_from_settings, cache_path
+from shamela.page_store import PageStore, contents_table
+from shamela.spiders.book import Book
+
+
+@dataclass
+class Result:
+    name: str
+    count: int
+    seconds: float
+    p50: float
+    p99: float
+    peak_memory: int
+
+    @property
+    def throughput(self) -> float:
+        return self.count / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f'{self.name:<32} {self.count:>8} {self.throughput:>12.1f}/s '
+            f'{self.p50 * 1e6:>10.1f}µs {self.p99 * 1e6:>10.1f}µs '
+            f'{self.peak_memory / 1024 / 1024:>9.2f}MiB'
+        )
+
+
+HEADER = (
+    f'{"stage":<32} {"count":>8} {"throughput":>14} {"p50":>12} {"p99":>12} {"peak memory":>12}'
+)
+
+
+def measure_calls(name: str, calls: Callable[[], Iterable[Callable[[], Any]]]) -> Result:
+    """
+    Time every call of a stage. Peak memory is measured in a second run of the stage,
+    so tracing allocations doesn't affect the timings.
+    :param name: stage name
+    :param calls: function that returns the calls of a run of the stage, called once per run
+    :return: benchmark result
+    """
+    timings = []
+    for call in calls():
+        started = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    for call in calls():
+        call()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    quantiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+    return Result(name, len(timings), sum(timings), quantiles[49], quantiles[98], peak_memory)
+
+
+def measure(name: str, function: Callable[[Any], Any], inputs: list[Any]) -> Result:
+    """
+    Time a function over every input
+    :param name: stage name
+    :param function: function to benchmark
+    :param inputs: function inputs
+    :return: benchmark result
+    """
+    return measure_calls(name, lambda: (partial(function, value) for value in inputs))
+
+
+def report(results: Iterable[Result]) -> None:
+    sys.stdout.write(HEADER + '\n')
+    for result in results:
+        sys.stdout.write(f'{result}\n')
+
+
+def book_spider(settings: BaseSettings) -> Book:
+    """
+    Book spider of a crawler that isn't started, with the signals, stats and request fingerprinter
+    used by its callbacks and the cache storages
+    :param settings: project settings
+    :return: book spider
+    """
+    crawler = Crawler(Book, Settings(settings))
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.request_fingerprinter = RequestFingerprinter(crawler)
+    return Book.from_crawler(crawler, book_id=1)
+
+
+def database_pages(database_url: str, limit: int | None = None) -> Iterator[str]:
+    """
+    Read the text of the pages stored in the database with STORE_PAGES
+    :param database_url: database URL
+    :param limit: maximum number of pages
+    :return: pages text
+    """
+    engine = create_db_engine(database_url)
+    with Session(engine) as session:
+        yield from session.scalars(select(Page.text).order_by(Page.id).limit(limit))
+    engine.dispose()
+
+
+def page_store_pages(path: str, limit: int | None = None) -> Iterator[str]:
+    """
+    Read the distinct page texts of the page store
+    :param path: page store path
+    :param limit: maximum number of pages
+    :return: pages text
+    """
+    store = PageStore(path)
+    try:
+        yield from store.connection.scalars(select(contents_table.c.text).limit(limit))
+    finally:
+        store.close()
+
+
+@dataclass
+class CachedResponse:
+    """
+    Response recorded by the HTTP cache storage. A new response is built on each replay,
+    as parsing modifies the response tree.
+    """
+
+    url: str
+    status: int
+    headers: dict[bytes, list[bytes]]
+    body: bytes
+
+    def replay(self, request: Request | None = None) -> Response:
+        headers = Headers(self.headers)
+        response_class = responsetypes.from_args(headers=headers, url=self.url, body=self.body)
+        return response_class(
+            url=self.url,
+            headers=headers,
+            status=self.status,
+            body=self.body,
+            request=request or Request(self.url),
+        )
+
+
+def cached_responses(
+    settings: BaseSettings, spider_name: str, url_pattern: str = '', limit: int | None = None
+) -> list[CachedResponse]:
+    """
+    Load the responses recorded by the HTTP cache storage, ordered by URL
+    :param settings: project settings
+    :param spider_name: name of the spider that recorded the responses
+    :param url_pattern: regex that the response URLs must match
+    :param limit: maximum number of responses
+    :return: recorded responses
+    """
+    if load_object(settings['HTTPCACHE_STORAGE']) is SqliteCacheStorage:
+        return _sqlite_cached_responses(settings, spider_name, re.compile(url_pattern), limit)
+    return _filesystem_cached_responses(settings, spider_name, re.compile(url_pattern), limit)
+
+
+def _sqlite_cached_responses(
+    settings: BaseSettings, spider_name: str, pattern: re.Pattern, limit: int | None
+) -> list[CachedResponse]:
+    if not cache_path(settings, spider_name).exists():
+        return []
+    cache = cache_from_settings(settings, spider_name)
+    try:
+        entries = sorted((url, f) for f, url in cache.urls() if pattern.search(url))[:limit]
+        responses = []
+        for _, fingerprint in entries:
+            if data := cache.get(fingerprint):
+                responses.append(
+                    CachedResponse(
+                        data['url'],
+                        data['status'],
+                        headers_raw_to_dict(data['headers']),
+                        data['body'],
+                    )
+                )
+        return responses
+    finally:
+        cache.close()
+
+
+def _filesystem_cached_responses(
+    settings: BaseSettings, spider_name: str, pattern: re.Pattern, limit: int | None
+) -> list[CachedResponse]:
+    open_file: Callable[..., Any] = gzip.open if settings.getbool('HTTPCACHE_GZIP') else open
+    entries = []
+    for meta_path in Path(data_path(settings['HTTPCACHE_DIR']), spider_name).glob(
+        '*/*/pickled_meta'
+    ):
+        with open_file(meta_path, 'rb') as f:
+            metadata = pickle.load(f)  # noqa: S301
+        if pattern.search(metadata['response_url']):
+            entries.append((metadata['response_url'], metadata['status'], meta_path.parent))
+    responses = []
+    for url, status, path in sorted(entries)[:limit]:
+        with open_file(path / 'response_body', 'rb') as f:
+            body = f.read()
+        with open_file(path / 'response_headers', 'rb') as f:
+            headers = headers_raw_to_dict(f.read())
+        responses.append(CachedResponse(url, status, headers, body))
+    return responses
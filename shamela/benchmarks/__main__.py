@@ -0,0 +1,152 @@
+import argparse
+import sys
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from functools import partial
+from io import BytesIO
+from typing import Any
+
+from scrapy import Request
+from scrapy.exporters import BaseItemExporter
+from scrapy.http import Response
+from scrapy.settings import BaseSettings
+from scrapy.utils import project
+
+from shamela.benchmarks import CachedResponse, book_spider, cached_responses, measure_calls, report
+from shamela.exporters.epub import EpubItemExporter
+from shamela.exporters.json import SortedJsonItemExporter
+from shamela.spiders.authors import Authors
+from shamela.spiders.book import Book
+from shamela.spiders.books import Books
+
+BOOK_URL_PATTERN = r'/book/\d+$'
+BOOK_PAGE_URL_PATTERN = r'/book/\d+/\d+'
+CATEGORY_URL_PATTERN = r'/category/'
+AUTHOR_URL_PATTERN = r'/author/'
+
+Calls = Callable[[], Iterator[Callable[[], Any]]]
+
+
+def _url_key(url: str) -> str:
+    return url.split('#')[0]
+
+
+def _replay(
+    callback: Callable[[Response], Iterable[Any]],
+    cached: CachedResponse,
+    results: list[Any],
+    request: Request | None = None,
+) -> None:
+    results.extend(callback(cached.replay(request)))
+
+
+class Suite:
+    """
+    Replay recorded book, category and author pages through the spiders callbacks and the exporters
+    """
+
+    def __init__(self, settings: BaseSettings, books: int | None, pages: int | None) -> None:
+        self.settings = settings
+        self.books = cached_responses(settings, Book.name, BOOK_URL_PATTERN, books)
+        self.book_pages = {
+            _url_key(response.url): response
+            for response in cached_responses(settings, Book.name, BOOK_PAGE_URL_PATTERN)
+        }
+        self.categories = cached_responses(settings, Books.name, CATEGORY_URL_PATTERN, pages)
+        self.authors = cached_responses(settings, Authors.name, AUTHOR_URL_PATTERN, pages)
+        # Items of the spiders stages are collected on their first run, for the exporters stages
+        self.book_items: list[dict[str, Any]] = []
+        self.category_items: list[list[dict[str, Any]]] = []
+
+    def book_index(self) -> Iterator[Callable[[], Any]]:
+        spider = book_spider(self.settings)
+        for cached in self.books:
+            yield partial(_replay, spider.parse, cached, [])
+
+    def book_text(self) -> Iterator[Callable[[], Any]]:
+        """
+        Follow the pages of each book from its index page, one call per page
+        """
+        spider = book_spider(self.settings)
+        collect = not self.book_items
+        for cached in self.books:
+            queue = deque(spider.parse(cached.replay()))
+            while queue:
+                request: Request = queue.popleft()
+                page = self.book_pages.get(_url_key(request.url))
+                if page is None or request.callback is None:
+                    continue
+                results: list[Any] = []
+                yield partial(_replay, request.callback, page, results, request)
+                for result in results:
+                    if isinstance(result, Request):
+                        queue.append(result)
+                    elif collect:
+                        self.book_items.append(result)
+
+    def category_pages(self) -> Iterator[Callable[[], Any]]:
+        spider = Books()
+        collect = not self.category_items
+        for cached in self.categories:
+            items: list[dict[str, Any]] = []
+            yield partial(_replay, spider.parse_item, cached, items)
+            if collect:
+                self.category_items.append(items)
+
+    def author_pages(self) -> Iterator[Callable[[], Any]]:
+        spider = Authors()
+        for cached in self.authors:
+            yield partial(_replay, spider.parse_item, cached, [])
+
+    def epub_export(self) -> Iterator[Callable[[], Any]]:
+        for item in self.book_items:
+            yield partial(self._export, EpubItemExporter, [item])
+
+    def json_export(self) -> Iterator[Callable[[], Any]]:
+        """
+        Export the books of each category page as a feed
+        """
+        for items in self.category_items:
+            yield partial(self._export, SortedJsonItemExporter, items)
+
+    @staticmethod
+    def _export(
+        exporter_class: Callable[[BytesIO], BaseItemExporter], items: list[dict[str, Any]]
+    ) -> None:
+        exporter = exporter_class(BytesIO())
+        exporter.start_exporting()
+        for item in items:
+            exporter.export_item(item)
+        exporter.finish_exporting()
+
+    def stages(self) -> list[tuple[str, Calls, list[Any]]]:
+        return [
+            ('Book.parse', self.book_index, self.books),
+            ('Book.parse_book_text', self.book_text, self.books),
+            ('Books.parse_item', self.category_pages, self.categories),
+            ('Authors.parse_item', self.author_pages, self.authors),
+            ('EpubItemExporter', self.epub_export, self.book_items),
+            ('SortedJsonItemExporter', self.json_export, self.category_items),
+        ]
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the spiders and exporters over the pages recorded in the HTTP cache'
+    )
+    parser.add_argument('--books', type=int, help='maximum number of books')
+    parser.add_argument('--pages', type=int, help='maximum number of category and author pages')
+    args = parser.parse_args()
+    suite = Suite(project.get_project_settings(), args.books, args.pages)
+    results = []
+    # Exporters stages run after the spiders stages that collect their items
+    for name, calls, inputs in suite.stages():
+        if inputs:
+            results.append(measure_calls(name, calls))
+        else:
+            sys.stdout.write(f'Skipping {name}, no recorded pages\n')
+    report(results)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,276 @@
+import argparse
+import re
+import sys
+from html import unescape
+
+from lxml.etree import Element, QName, tostring
+from parsel import SelectorList
+from scrapy import Selector
+from scrapy.utils import project
+
+from shamela.benchmarks import measure, page_store_pages, report
+from shamela.exporters.epub import (
+    ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN,
+    ARABIC_NUMBER_BETWEEN_CURLY_BRACES_PATTERN,
+    AYAH_PATTERN,
+    HAMESH_CONTINUATION_PATTERN,
+    HAMESH_PATTERN,
+    EpubItemExporter,
+)
+from shamela.normalize import SPECIAL_CHARACTERS_TABLE
+
+ARABIC_DIGITS = str.maketrans('0123456789', '٠١٢٣٤٥٦٧٨٩')
+FOOTNOTE_LINK_PATTERN = re.compile(r'id="fnref\d+"')
+EPUB_TYPE = QName('http://www.idpf.org/2007/ops', 'type')
+
+
+def number(value: int) -> str:
+    return f'({str(value).translate(ARABIC_DIGITS)})'
+
+
+def ayah(text: str) -> str:
+    return f'﴿{text}﴾'  # noqa: RUF001
+
+
+def dense_page(paragraphs: int, footnotes_per_paragraph: int) -> str:
+    """
+    Page of a hadith collection, with a footnote at every narrator and an ayah in every third paragraph
+    """
+    text: list[str] = []
+    hamesh: list[str] = []
+    for paragraph in range(paragraphs):
+        footnotes = range(
+            paragraph * footnotes_per_paragraph + 1, (paragraph + 1) * footnotes_per_paragraph + 1
+        )
+        narrators = ' '.join(
+            f'حدثنا <span class="c2">فلان</span> {number(n)} قال' for n in footnotes
+        )
+        if paragraph % 3 == 0:
+            narrators += f' قال تعالى {ayah(f"وَالْفَجْرِ {number(1)} وَلَيَالٍ عَشْرٍ {number(2)}")}'
+        text.append(f'<p>{narrators}</p>')
+        hamesh.extend(f'{number(n)} هو فلان بن فلان، ثقة.' for n in footnotes)
+    return (
+        f'<div>{"".join(text)}<hr width="95" align="right">'
+        f'<p class="hamesh">{"<br>".join(hamesh)}</p></div>'
+    )
+
+
+# Name, page HTML and number of footnote links it must have
+FIXTURES: list[tuple[str, str, int]] = [
+    ('no hamesh', f'<div><p>نص {number(1)} بلا هامش</p></div>', 0),
+    (
+        'footnotes',
+        f'<div><p>حدثنا فلان {number(1)} عن فلان {number(2)}</p><p>قال {number(3)}</p>'
+        f'<p class="hamesh">{number(1)} الأولى<br>{number(2)} الثانية<br>{number(3)} الثالثة</p>'
+        '</div>',
+        3,
+    ),
+    (
+        'more numbers than footnotes',
+        f'<div><p>حدثنا فلان {number(1)} عن فلان {number(2)} عن فلان {number(3)}</p>'
+        f'<p class="hamesh">{number(1)} الأولى</p></div>',
+        1,
+    ),
+    (
+        'ayah numbers',
+        f'<div><p>قال تعالى {ayah(f"الم {number(1)} ذَلِكَ الْكِتَابُ {number(2)}")} {number(1)}</p>'
+        f'<p>ثم {ayah(f"هُدًى لِلْمُتَّقِينَ {number(2)}")} {number(2)}</p>'
+        f'<p class="hamesh">{number(1)} سورة البقرة<br>{number(2)} سورة البقرة</p></div>',
+        2,
+    ),
+    (
+        'curly braces ayah',
+        f'<div><p>{{قُلْ هُوَ اللَّهُ أَحَدٌ {number(1)} اللَّهُ الصَّمَدُ}} ثم {number(1)} وبعده {number(2)}</p>'
+        f'<p>قال {number(1)}</p>'
+        f'<p class="hamesh">{number(1)} الأولى<br>{number(2)} الثانية<br>{number(3)} الثالثة</p>'
+        '</div>',
+        2,
+    ),
+    (
+        'continuation',
+        f'<div><p>قال {number(1)}</p>'
+        f'<p class="hamesh">= تتمة حاشية الصفحة السابقة<br>{number(1)} الأولى</p></div>',
+        1,
+    ),
+    (
+        'continued footnote',
+        f'<div><p>قال {number(1)}</p>'
+        f'<p class="hamesh">{number(1)} الأولى <span class="c2">=</span></p></div>',
+        1,
+    ),
+    (
+        'footnotes with markup',
+        f'<div><p><span class="c1">حدثنا {number(1)}</span> عن <span>فلان {number(2)}</span></p>'
+        f'<p class="hamesh">{number(1)} <span class="c3">الأولى</span><br>'
+        f'{number(2)} الثانية &amp; الثالثة</p></div>',
+        2,
+    ),
+    ('dense hadith page', dense_page(30, 5), 150),
+]
+
+
+def element_as_text(element: Element) -> str:
+    return unescape(tostring(element, encoding='utf-8').decode())
+
+
+def legacy_get_hamesh_items(hamesh: SelectorList[Selector]) -> dict[int, Element]:
+    hamesh_items: dict[int, Element] = {}
+    hamesh_counter = 0
+    for hamesh_item in hamesh.getall():
+        _hamesh_item = hamesh_item
+        if hamesh_continuation := HAMESH_CONTINUATION_PATTERN.search(hamesh_item):
+            hamesh_text = f'{hamesh_continuation.group("continuation")}<br>'
+            for p in hamesh_item.split('<br>')[1:]:
+                if ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN.match(p):
+                    break
+                hamesh_text += f'{p}<br>'
+            aside = Element('aside', {'id': f'fn{hamesh_counter}', EPUB_TYPE: 'footnote'})
+            span = Element('span')
+            span.text = hamesh_text.strip()
+            aside.append(span)
+            hamesh_items.update({0: aside})
+            _hamesh_item = _hamesh_item.replace(hamesh_text, '')
+        for match in HAMESH_PATTERN.finditer(_hamesh_item):
+            hamesh_counter += 1
+            aside = Element('aside', {'id': f'fn{hamesh_counter}', EPUB_TYPE: 'footnote'})
+            span = Element('span')
+            a = Element('a', {'href': f'#fnref{hamesh_counter}', 'class': 'nu'})
+            a.text = match.group('number').strip()
+            span.text = ' ' + match.group('content').strip()
+            aside.append(a)
+            aside.append(span)
+            hamesh_items.update({hamesh_counter: aside})
+    return hamesh_items
+
+
+def legacy_create_footnote_link(footnote_count: int, number: str) -> Element:
+    footnote_link: Element = Element(
+        'a',
+        {
+            'href': f'#fn{footnote_count}',
+            EPUB_TYPE: 'noteref',
+            'role': 'doc-noteref',
+            'id': f'fnref{footnote_count}',
+            'class': 'fn nu',
+        },
+    )
+    footnote_link.text = number
+    return footnote_link
+
+
+def legacy_is_aya_match(text: str, match: re.Match, number: str) -> bool:
+    aya_match = ARABIC_NUMBER_BETWEEN_CURLY_BRACES_PATTERN.search(text)
+    return bool(
+        aya_match and number in aya_match.group() and match.start('number') > aya_match.start()
+    )
+
+
+def legacy_update_hamesh(content: Selector) -> Selector:  # noqa: C901, PLR0912
+    """
+    Footnote linking before it was done in a single pass, as a baseline of
+    EpubItemExporter._update_hamesh
+    """
+    new_content = content.css('div').get('')
+    hamesh: SelectorList[Selector] = content.css('.hamesh')
+    if not hamesh:
+        return content
+    hamesh_items = legacy_get_hamesh_items(hamesh)
+    new_hamesh = Element('div', {'class': 'hamesh'})
+    hamesh_continuation = hamesh_items.pop(0, None)
+    if hamesh_continuation is not None:
+        new_hamesh.append(hamesh_continuation)
+    p_elements: SelectorList[Selector] = content.css('p:not(.hamesh)')
+    aya_matches = AYAH_PATTERN.findall(''.join(p_elements.getall()))
+    if aya_matches:
+        for idx, aya in enumerate(aya_matches, start=1):
+            new_content = new_content.replace(aya, f'PLACEHOLDER_{idx}')
+        p_elements = Selector(text=new_content).css('p:not(.hamesh)')
+    footnote_count = 1
+    p_replacements = []
+    for p in p_elements:
+        p_text = p.get()
+        replacements = []
+        for match in ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN.finditer(p_text):
+            number = match.group('number')
+            if hamesh_items.get(footnote_count) is None:
+                continue
+            if legacy_is_aya_match(p_text, match, number):
+                continue
+            link = legacy_create_footnote_link(footnote_count, number)
+            replacements.append((match.start(), match.end(), element_as_text(link)))
+            new_hamesh.append(hamesh_items[footnote_count])
+            footnote_count += 1
+        if replacements:
+            for start, end, replacement in reversed(replacements):
+                p_text = p_text[:start] + replacement + p_text[end:]
+            p_replacements.append((p.get(), p_text))
+    for original, replacement in reversed(p_replacements):
+        new_content = new_content.replace(original, replacement)
+    if aya_matches:
+        for idx, aya in enumerate(aya_matches, start=1):
+            new_content = new_content.replace(f'PLACEHOLDER_{idx}', aya)
+    return Selector(text=new_content.replace(hamesh.get(''), element_as_text(new_hamesh)))
+
+
+def legacy(page: str) -> str:
+    return legacy_update_hamesh(Selector(text=page)).css('div').get('')
+
+
+def check_fixtures() -> int:
+    """
+    Link the footnotes of the fixtures, and report the ones linked wrongly or differently
+    than the legacy implementation
+    :return: number of failed fixtures
+    """
+    failures = 0
+    for name, page, links in FIXTURES:
+        linked = EpubItemExporter._update_hamesh(page)
+        if (count := len(FOOTNOTE_LINK_PATTERN.findall(linked))) != links:
+            sys.stdout.write(f'{name}: {count} footnote links instead of {links}\n')
+            failures += 1
+        elif linked != legacy(page):
+            sys.stdout.write(f'{name}: linked differently than the legacy implementation\n')
+            failures += 1
+    return failures
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(
+        description='Check and benchmark footnote linking, over the fixtures and the stored pages'
+    )
+    parser.add_argument(
+        '--page-store',
+        nargs='?',
+        const=settings.get('PAGE_STORE_PATH'),
+        help='also compare and benchmark over the pages of the page store',
+    )
+    parser.add_argument('--limit', type=int, help='maximum number of stored pages')
+    parser.add_argument(
+        '--dense-pages', type=int, default=200, help='synthetic hadith pages (default: 200)'
+    )
+    args = parser.parse_args()
+    if failures := check_fixtures():
+        sys.stdout.write(f'{failures} of {len(FIXTURES)} fixtures failed\n')
+    stored = [
+        page.translate(SPECIAL_CHARACTERS_TABLE)
+        for page in (page_store_pages(args.page_store, args.limit) if args.page_store else [])
+        if 'hamesh' in page
+    ]
+    dense = [dense_page(30, 5)] * args.dense_pages
+    results = [
+        measure('legacy dense pages', legacy, dense),
+        measure('_update_hamesh dense pages', EpubItemExporter._update_hamesh, dense),
+    ]
+    if stored:
+        results += [
+            measure('legacy stored pages', legacy, stored),
+            measure('_update_hamesh stored pages', EpubItemExporter._update_hamesh, stored),
+        ]
+    report(results)
+    if mismatches := sum(legacy(page) != EpubItemExporter._update_hamesh(page) for page in stored):
+        sys.stdout.write(f'{mismatches} stored pages are linked differently\n')
+
+
+if __name__ == '__main__':
+    run()
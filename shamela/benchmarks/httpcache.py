@@ -0,0 +1,99 @@
+import argparse
+import sys
+import tempfile
+from collections.abc import Callable, Iterator
+from functools import partial
+from pathlib import Path
+from typing import Any
+
+from scrapy import Request
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.settings import BaseSettings
+from scrapy.utils import project
+
+from shamela.benchmarks import (
+    CachedResponse,
+    Result,
+    book_spider,
+    cached_responses,
+    measure_calls,
+    report,
+)
+from shamela.httpcache import SqliteCacheStorage
+from shamela.spiders.book import Book
+
+
+def _disk_usage(path: Path) -> tuple[int, int]:
+    """
+    Number of files and allocated size, which counts the block left partly empty by each file
+    """
+    files = [f for f in path.rglob('*') if f.is_file()]
+    return len(files), sum(f.stat().st_blocks * 512 for f in files)
+
+
+def benchmark_storage(
+    settings: BaseSettings, storage_class: type, responses: list[CachedResponse]
+) -> tuple[list[Result], int, int]:
+    """
+    Store the responses then retrieve them from a new cache in a temporary directory
+    :param settings: project settings
+    :param storage_class: cache storage class
+    :param responses: responses to store
+    :return: benchmark results of storing and retrieving the responses, number and size of the
+    cache files
+    """
+    name = storage_class.__name__.removesuffix('CacheStorage')
+    with tempfile.TemporaryDirectory() as directory:
+        settings = settings.copy()
+        settings.set('HTTPCACHE_DIR', directory)
+        settings.set('HTTPCACHE_EXPIRATION_SECS', 0)
+        spider = book_spider(settings)
+        pairs = [(Request(response.url), response.replay()) for response in responses]
+
+        def store() -> Iterator[Callable[[], Any]]:
+            storage = storage_class(settings)
+            storage.open_spider(spider)
+            for request, response in pairs:
+                yield partial(storage.store_response, spider, request, response)
+            storage.close_spider(spider)
+
+        def retrieve() -> Iterator[Callable[[], Any]]:
+            storage = storage_class(settings)
+            storage.open_spider(spider)
+            for request, _ in pairs:
+                yield partial(storage.retrieve_response, spider, request)
+            storage.close_spider(spider)
+
+        results = [
+            measure_calls(f'{name}.store_response', store),
+            measure_calls(f'{name}.retrieve_response', retrieve),
+        ]
+        # The responses of the second store run replaced the ones of the first run
+        files, size = _disk_usage(Path(directory))
+    return results, files, size
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HTTP cache storages over the book pages recorded in the HTTP cache'
+    )
+    parser.add_argument('--limit', type=int, help='maximum number of responses')
+    args = parser.parse_args()
+    responses = cached_responses(settings, Book.name, limit=args.limit)
+    if not responses:
+        parser.error('No recorded responses found, crawl some books with HTTPCACHE_ENABLED first')
+    results = []
+    disk_usage = []
+    for storage_class in (FilesystemCacheStorage, SqliteCacheStorage):
+        storage_results, files, size = benchmark_storage(settings, storage_class, responses)
+        results.extend(storage_results)
+        disk_usage.append(
+            f'{storage_class.__name__}: {files} files, {size / 1024 / 1024:.2f} MiB\n'
+        )
+    report(results)
+    sys.stdout.write(''.join(disk_usage))
+
+
+if __name__ == '__main__':
+    run()
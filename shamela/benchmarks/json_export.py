@@ -0,0 +1,133 @@
+import argparse
+import json
+import sys
+import tempfile
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any
+
+from scrapy.utils import project
+
+from shamela.benchmarks import Result, measure_calls, report
+from shamela.exporters.json import BookJsonItemExporter, json_compact_dumps, orjson
+from shamela.page_store import PageStore, page_range
+
+# Text of a synthetic page, about the size of a page of a printed book
+PAGE_TEXT = (
+    '<p>حدثنا محمد بن عبد الله قال: حدثنا <span class="c2">سفيان</span> عن الأعمش عن إبراهيم.</p>\n'
+    * 20
+)
+
+
+class JsonCompactExporter(BookJsonItemExporter):
+    """
+    Compact exporter with the standard library serializer, whether orjson is installed or not
+    """
+
+    compact_dumps = staticmethod(json_compact_dumps)
+
+
+def synthetic_book(pages: int) -> dict[str, Any]:
+    return {
+        'info': {'id': 0, 'title': 'كتاب', 'pages': pages, 'volumes': {'1': [1, pages]}},
+        'pages': [
+            {'page_number': number, 'page': number, 'text': PAGE_TEXT}
+            for number in range(1, pages + 1)
+        ],
+    }
+
+
+def stored_book(path: str, book_id: int) -> dict[str, Any] | None:
+    """
+    Read a book of the page store with its pages in memory, so only the serialization is measured
+    """
+    store = PageStore(path)
+    try:
+        if (info := store.get_book(book_id)) is None:
+            return None
+        return {'info': info, 'pages': list(store.pages(book_id, page_range(info)))}
+    finally:
+        store.close()
+
+
+def dump_book(item: dict[str, Any], path: Path) -> None:
+    """
+    Serialize the whole book to a string then encode it, as a baseline of the streaming exporters
+    """
+    path.write_bytes(json.dumps([item], ensure_ascii=False, indent=1).encode('utf-8'))
+
+
+def export_book(exporter_class: type[BookJsonItemExporter], compact: bool) -> Callable[..., None]:
+    def export(item: dict[str, Any], path: Path) -> None:
+        with path.open('wb') as f:
+            exporter = exporter_class(f, compact=compact)
+            exporter.start_exporting()
+            exporter.export_item(item)
+            exporter.finish_exporting()
+
+    return export
+
+
+def benchmark_export(
+    name: str, export: Callable[[dict[str, Any], Path], None], item: dict[str, Any], repeat: int
+) -> tuple[Result, int]:
+    """
+    Export the book to a temporary file repeat times
+    :param name: stage name
+    :param export: function that writes the book to a path
+    :param item: book item
+    :param repeat: number of exports
+    :return: benchmark result and size of the file
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / 'book.json'
+
+        def calls() -> Iterator[Callable[[], None]]:
+            for _ in range(repeat):
+                yield lambda: export(item, path)
+
+        result = measure_calls(name, calls)
+        return result, path.stat().st_size
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(
+        description='Benchmark the book JSON serializers, from a book of the page store or a synthetic one'
+    )
+    parser.add_argument('--book-id', type=int, help='book ID in the page store')
+    parser.add_argument(
+        '--page-store', default=settings.get('PAGE_STORE_PATH'), help='page store path'
+    )
+    parser.add_argument(
+        '--pages', type=int, default=20_000, help='pages of the synthetic book (default: 20000)'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='exports per serializer')
+    args = parser.parse_args()
+    item = (
+        synthetic_book(args.pages)
+        if args.book_id is None
+        else stored_book(args.page_store, args.book_id)
+    )
+    if item is None:
+        parser.error(f'Book {args.book_id} is not in the page store')
+    stages: list[tuple[str, Callable[[dict[str, Any], Path], None]]] = [
+        ('json.dumps whole book', dump_book),
+        ('BookJsonItemExporter', export_book(BookJsonItemExporter, compact=False)),
+        ('BookJsonItemExporter compact', export_book(JsonCompactExporter, compact=True)),
+    ]
+    if orjson is not None:
+        stages.append(
+            ('BookJsonItemExporter orjson', export_book(BookJsonItemExporter, compact=True))
+        )
+    results, sizes = [], []
+    for name, export in stages:
+        result, size = benchmark_export(name, export, item, args.repeat)
+        results.append(result)
+        sizes.append(f'{name}: {size / 1024 / 1024:.2f} MiB\n')
+    report(results)
+    sys.stdout.write(''.join(sizes))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,56 @@
+import argparse
+import re
+from html import unescape
+
+from scrapy.utils import project
+
+from shamela.benchmarks import database_pages, measure, page_store_pages, report
+from shamela.normalize import FOLDED_CHARACTERS, REMOVED_CHARACTERS, SPECIAL_CHARACTERS, search_text
+
+SPECIAL_CHARACTERS_PATTERN = re.compile('|'.join(map(re.escape, SPECIAL_CHARACTERS)))
+REMOVED_CHARACTERS_PATTERN = re.compile(f'[{"".join(REMOVED_CHARACTERS)}]')
+FOLDED_CHARACTERS_PATTERNS = [(re.compile(k), v) for k, v in FOLDED_CHARACTERS.items()]
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def chained_search_text(html: str) -> str:
+    """
+    Normalize page HTML with one regex substitution per step, as a baseline of search_text
+    """
+    text = unescape(HTML_TAG_PATTERN.sub(' ', html))
+    text = SPECIAL_CHARACTERS_PATTERN.sub(lambda match: SPECIAL_CHARACTERS[match.group(0)], text)
+    text = REMOVED_CHARACTERS_PATTERN.sub('', text)
+    for pattern, replacement in FOLDED_CHARACTERS_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(description='Benchmark Arabic text normalization per page')
+    parser.add_argument(
+        '--page-store',
+        nargs='?',
+        const=settings.get('PAGE_STORE_PATH'),
+        help='read the pages from the page store instead of the database pages table',
+    )
+    parser.add_argument('--limit', type=int, help='maximum number of pages')
+    args = parser.parse_args()
+    pages = list(
+        page_store_pages(args.page_store, args.limit)
+        if args.page_store
+        else database_pages(settings.get('DATABASE_URL'), args.limit)
+    )
+    if not pages:
+        parser.error('No pages found, crawl some books with STORE_PAGES or RESUME_PAGES first')
+    report(
+        [
+            measure('chained regex normalization', chained_search_text, pages),
+            measure('search_text', search_text, pages),
+        ]
+    )
+
+
+if __name__ == '__main__':
+    run()
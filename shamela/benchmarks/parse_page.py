@@ -0,0 +1,63 @@
+import argparse
+import re
+import sys
+from typing import Any
+
+from scrapy import Selector
+from scrapy.http import Response
+from scrapy.utils import project
+
+from shamela.benchmarks import CachedResponse, cached_responses, measure, report
+from shamela.spiders.book import Book, Selectors
+
+PARENT_DIV_CLASS_PATTERN = re.compile(r' class="nass margin-top-10"')
+HTML_STYLE_PATTERN = re.compile(r' style="(.*?)"')
+PAGE_URL_PATTERN = r'/book/\d+/\d+'
+
+
+def legacy_parse_page(response: Response, page_number: int) -> dict[str, Any]:
+    """
+    Page cleaning before it was done in a single pass, as a baseline of Book._parse_page
+    """
+    page = int(response.css(f'{Selectors.PAGE_NUMBER.value}::attr(value)').get('0'))
+    content = response.css(Selectors.PAGE_CONTENT.value)
+    content.css(Selectors.COPY_BTN.value).drop()
+    html = Selector(text=PARENT_DIV_CLASS_PATTERN.sub('', content.get('')))
+    for element in html.css('span'):
+        if not element.css('::text').get():
+            element.drop()
+    for _ in html.css('p[style="font-size: 15px"]'):
+        _ = Selector(text=HTML_STYLE_PATTERN.sub('', html.get()))
+    return {'page_number': page_number, 'page': page, 'text': html.css('div').get()}
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(
+        description='Benchmark book page cleaning over the pages recorded in the HTTP cache'
+    )
+    parser.add_argument('--limit', type=int, help='maximum number of pages')
+    args = parser.parse_args()
+    pages = cached_responses(settings, Book.name, PAGE_URL_PATTERN, args.limit)
+    if not pages:
+        parser.error('No book pages found in the HTTP cache, crawl some books first')
+    spider = Book(book_id=1)
+
+    def legacy(page: CachedResponse) -> dict[str, Any]:
+        return legacy_parse_page(page.replay(), 0)
+
+    def single_pass(page: CachedResponse) -> dict[str, Any]:
+        return spider._parse_page(page.replay(), 0)
+
+    report(
+        [
+            measure('legacy page cleaning', legacy, pages),
+            measure('page cleaning', single_pass, pages),
+        ]
+    )
+    if mismatches := sum(legacy(page) != single_pass(page) for page in pages):
+        sys.stdout.write(f'{mismatches} pages are cleaned differently\n')
+
+
+if __name__ == '__main__':
+    run()
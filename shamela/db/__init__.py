@@ -1,7 +1,62 @@
 from datetime import datetime
-
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
-from sqlalchemy.orm import DeclarativeBase, relationship
+from typing import Any
+
+from scrapy.settings import BaseSettings
+from sqlalchemy import (
+    DDL,
+    Column,
+    ColumnElement,
+    DateTime,
+    Engine,
+    ForeignKey,
+    Integer,
+    String,
+    UniqueConstraint,
+    cast,
+    create_engine,
+    event,
+    func,
+    select,
+    text,
+)
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import DeclarativeBase, Session, relationship
+from sqlalchemy.pool import StaticPool
+
+from shamela.normalize import search_text
+
+DATABASE_URL = 'sqlite:///shamela.db'
+
+
+def create_db_engine(url: str = DATABASE_URL, pragmas: dict[str, Any] | None = None) -> Engine:
+    """
+    Create a database engine, SQLite engines with pragmas use a single long-lived connection
+    :param url: database URL
+    :param pragmas: SQLite pragmas to set on the connection
+    :return: engine
+    """
+    if not pragmas or not url.startswith('sqlite'):
+        return create_engine(url)
+    engine = create_engine(url, poolclass=StaticPool)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection: Any, _: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return engine
+
+
+def sqlite_pragmas(settings: BaseSettings) -> dict[str, Any] | None:
+    if not settings.getbool('SQLITE_PERFORMANCE_PROFILE'):
+        return None
+    return settings.getdict('SQLITE_PRAGMAS')
+
+
+def engine_from_settings(settings: BaseSettings) -> Engine:
+    return create_db_engine(settings.get('DATABASE_URL', DATABASE_URL), sqlite_pragmas(settings))
 
 
 class Base(DeclarativeBase):
@@ -43,6 +98,10 @@ class Book(Base):
     volumes = Column(Integer, default=1)
     pages = Column(Integer)
     category_id = Column(Integer, ForeignKey('categories.id'))
+    # Listing and content fingerprints of the last exported crawl, used by incremental crawls
+    exported_listing = Column(String)
+    exported_content = Column(String)
+    exported_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -53,5 +112,97 @@ class Book(Base):
     def link(self) -> str:
         return f'https://shamela.ws/book/{self.id}'
 
+    @hybrid_property
+    def listing_fingerprint(self) -> str:
+        return f'{self.pages}:{self.volumes}'
+
+    @listing_fingerprint.inplace.expression
+    @classmethod
+    def _listing_fingerprint_expression(cls) -> ColumnElement[str]:
+        return (
+            func.coalesce(cast(cls.pages, String), 'None')
+            + ':'
+            + func.coalesce(cast(cls.volumes, String), 'None')
+        )
+
+    @property
+    def is_listing_unchanged(self) -> bool:
+        """
+        Whether the book listing still has the same pages and volumes it had when the book was exported.
+        Books with unknown pages count are never considered unchanged.
+        """
+        return bool(
+            self.pages and self.pages > 0 and self.exported_listing == self.listing_fingerprint
+        )
+
     def __repr__(self) -> str:
         return f'<Book ({self.id}) {self.title}, {self.author}, {self.category}>'
+
+
+class Page(Base):
+    __tablename__ = 'pages'
+    __table_args__ = (UniqueConstraint('book_id', 'page_number'),)
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    page_number = Column(Integer, nullable=False)
+    page = Column(Integer)
+    volume = Column(String)
+    text = Column(String)
+    # Normalized plain text indexed by pages_fts
+    search_text = Column(String)
+
+    book = relationship('Book')
+
+    def __repr__(self) -> str:
+        return f'<Page ({self.book_id}) {self.page_number}>'
+
+
+# Full-text index over pages.search_text, kept in sync by triggers
+PAGES_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(search_text, content='pages', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    'CREATE TRIGGER IF NOT EXISTS pages_fts_insert AFTER INSERT ON pages BEGIN '
+    'INSERT INTO pages_fts(rowid, search_text) VALUES (new.id, new.search_text); END',
+    'CREATE TRIGGER IF NOT EXISTS pages_fts_delete AFTER DELETE ON pages BEGIN '
+    'INSERT INTO pages_fts(pages_fts, rowid, search_text) '
+    "VALUES ('delete', old.id, old.search_text); END",
+    'CREATE TRIGGER IF NOT EXISTS pages_fts_update AFTER UPDATE OF search_text ON pages BEGIN '
+    'INSERT INTO pages_fts(pages_fts, rowid, search_text) '
+    "VALUES ('delete', old.id, old.search_text); "
+    'INSERT INTO pages_fts(rowid, search_text) VALUES (new.id, new.search_text); END',
+)
+for statement in PAGES_FTS_DDL:
+    event.listen(Page.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+def search_pages(session: Session, phrase: str, limit: int = 20) -> list[Any]:
+    """
+    Search the pages of all the crawled books for a phrase
+    :param session: database session
+    :param phrase: phrase to search for, normalized the same way as the indexed pages
+    :param limit: maximum number of results
+    :return: rows of book ID, page number, page, volume and a snippet of the matched text
+    """
+    query = '"' + search_text(phrase).replace('"', '""') + '"'
+    return list(
+        session.execute(
+            text(
+                'SELECT pages.book_id, pages.page_number, pages.page, pages.volume, '
+                "snippet(pages_fts, 0, '[', ']', '…', 16) AS snippet "
+                'FROM pages_fts JOIN pages ON pages.id = pages_fts.rowid '
+                'WHERE pages_fts MATCH :query ORDER BY rank LIMIT :limit'
+            ),
+            {'query': query, 'limit': limit},
+        )
+    )
+
+
+def get_book_ids(engine: Engine) -> list[int]:
+    with Session(engine) as session:
+        return list(session.scalars(select(Book.id).order_by(Book.id)))
+
+
+def get_books(engine: Engine) -> dict[int, Book]:
+    with Session(engine) as session:
+        return dict(session.execute(select(Book.id, Book)).tuples().all())
@@ -0,0 +1,28 @@
+"""Add export fingerprints to book table
+
+Revision ID: 9c1e4f2a7b3d
+Revises: 5912092c4e24
+Create Date: 2026-10-17 12:04:31.218394
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c1e4f2a7b3d'
+down_revision = '5912092c4e24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('books', sa.Column('exported_listing', sa.String(), nullable=True))
+    op.add_column('books', sa.Column('exported_content', sa.String(), nullable=True))
+    op.add_column('books', sa.Column('exported_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('books', 'exported_at')
+    op.drop_column('books', 'exported_content')
+    op.drop_column('books', 'exported_listing')
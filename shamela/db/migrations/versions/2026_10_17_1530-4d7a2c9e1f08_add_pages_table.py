@@ -0,0 +1,56 @@
+"""Add pages table
+
+Revision ID: 4d7a2c9e1f08
+Revises: 9c1e4f2a7b3d
+Create Date: 2026-10-17 15:30:12.406218
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '4d7a2c9e1f08'
+down_revision = '9c1e4f2a7b3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'pages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('book_id', sa.Integer(), nullable=False),
+        sa.Column('page_number', sa.Integer(), nullable=False),
+        sa.Column('page', sa.Integer(), nullable=True),
+        sa.Column('volume', sa.String(), nullable=True),
+        sa.Column('text', sa.String(), nullable=True),
+        sa.Column('search_text', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['book_id'], ['books.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('book_id', 'page_number'),
+    )
+    op.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(search_text, content='pages', "
+        "content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_insert AFTER INSERT ON pages BEGIN '
+        'INSERT INTO pages_fts(rowid, search_text) VALUES (new.id, new.search_text); END'
+    )
+    op.execute(
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_delete AFTER DELETE ON pages BEGIN '
+        'INSERT INTO pages_fts(pages_fts, rowid, search_text) '
+        "VALUES ('delete', old.id, old.search_text); END"
+    )
+    op.execute(
+        'CREATE TRIGGER IF NOT EXISTS pages_fts_update AFTER UPDATE OF search_text ON pages BEGIN '
+        'INSERT INTO pages_fts(pages_fts, rowid, search_text) '
+        "VALUES ('delete', old.id, old.search_text); "
+        'INSERT INTO pages_fts(rowid, search_text) VALUES (new.id, new.search_text); END'
+    )
+
+
+def downgrade() -> None:
+    op.execute('DROP TABLE IF EXISTS pages_fts')
+    op.drop_table('pages')
@@ -1,14 +1,24 @@
 import re
+import zipfile
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, Future
 from copy import deepcopy
-from html import unescape
+from dataclasses import dataclass
 from io import BytesIO
+from itertools import batched
 from re import Pattern
 from typing import Any, BinaryIO
+from xml.sax.saxutils import quoteattr
 
 from ebooklib import epub
-from lxml.etree import Element, QName, tostring
+from ebooklib.utils import get_pages
 from scrapy.exporters import BaseItemExporter
-from scrapy.selector import Selector, SelectorList
+from scrapy.selector import Selector
+
+from shamela.instrumentation import timed
+from shamela.normalize import SPECIAL_CHARACTERS_TABLE
+from shamela.utils import VolumeIndex
 
 CSS_STYLE_COLOR_PATTERN: Pattern = re.compile(r'style="(color:#[\w\d]{6})"')
 HAMESH_CONTINUATION_PATTERN: Pattern = re.compile(r'(?<=>)(?P<continuation>=.+?)(?=<br>|</p>)')
@@ -18,42 +28,123 @@ HAMESH_PATTERN: Pattern = re.compile(
 ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN: Pattern = re.compile(r'(?P<number>\([\u0660-\u0669]+\))')
 ARABIC_NUMBER_BETWEEN_CURLY_BRACES_PATTERN: Pattern = re.compile(r'{.+?(\([\u0660-\u0669]+\)).+?}')
 AYAH_PATTERN: Pattern = re.compile(r'﴿[\s\S]+?﴾')  # noqa: RUF001
-SPECIAL_CHARACTERS = {
-    '﵀': 'رحمه الله',
-    '﵏': 'رحمهم الله',
-    '﷿': 'عز وجل',
-    '﵊': 'عليه الصلاة والسلام',
-    '﵄': 'رضي الله عنهما',
-    '﵃': 'رضي الله عنهم',
-    '﵅': 'رضي الله عنهن',
-    '﵂': 'رضي الله عنها',
-    '﵁': 'رضي الله عنه',
-    '﷾': 'سبحانه وتعالى',
-    '﵎': 'تبارك وتعالى',
-    '﵇': 'عليه السلام',
-    '﵍': 'عليها السلام',
-    '﵈': 'عليهم السلام',
-    '﵉': 'عليهما السلام',
-    '﵌': 'صلى الله عليه وآله وسلم',
-}
-SPECIAL_CHARACTERS_PATTERN = re.compile('|'.join(map(re.escape, SPECIAL_CHARACTERS.keys())))
+AYAH_PLACEHOLDER_PATTERN: Pattern = re.compile(r'\x00(\d+)\x00')
+PARAGRAPH_PATTERN: Pattern = re.compile(r'<p(?P<attributes>\s[^>]*)?>.*?</p>', re.DOTALL)
+HAMESH_CLASS_PATTERN: Pattern = re.compile(r'\sclass="(?:[^"]*\s)?hamesh[\s"]')
 TITLE_PATTERN = re.compile(r'<p><span class="([^"]*)">\[[^\]]*\]</span></p>')
 EPUB_CSS = (
     '*{direction: rtl}.text-center, h2{text-align: center}.hamesh{font-size: smaller}'
     '.fn{font-size: x-small;vertical-align: super;color: inherit}.nu{text-decoration: none}'
     '.hamesh .nu{color: #008000}aside[type=footnote]{-cr-hint: non-linear-combining}'
 )
-EPUB_TYPE = QName('http://www.idpf.org/2007/ops', 'type')
+# Footnote links and footnotes, in the markup lxml serialized the footnote elements to
+FOOTNOTE_LINK = (
+    '<a xmlns:ns0="http://www.idpf.org/2007/ops" href="#fn{count}" ns0:type="noteref" '
+    'role="doc-noteref" id="fnref{count}" class="fn nu">{number}</a>'
+)
+FOOTNOTE = (
+    '<aside xmlns:ns0="http://www.idpf.org/2007/ops" id="fn{count}" ns0:type="footnote">'
+    '<a href="#fnref{count}" class="nu">{number}</a><span> {text}</span></aside>'
+)
+CONTINUED_FOOTNOTE = (
+    '<aside xmlns:ns0="http://www.idpf.org/2007/ops" id="fn{count}" ns0:type="footnote">'
+    '<span>{text}</span></aside>'
+)
+# Pages sent together to a rendering process, and batches rendered ahead of the one being written
+RENDER_BATCH_SIZE = 16
+RENDER_BATCHES_AHEAD = 32
+
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    Write the documents of a book to the EPUB container as soon as they are rendered, and the package
+    document, navigation and the other items when the book is closed. A written document only keeps
+    its metadata, so the memory doesn't grow with the book text.
+    """
+
+    def __init__(self, file: BytesIO | BinaryIO, book: epub.EpubBook) -> None:
+        super().__init__(file, book)
+        self.out = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+        self._written: set[str] = set()
+
+    def write_document(self, item: epub.EpubHtml) -> None:
+        # The navigation lists the elements of the documents that have an epub:type and an id,
+        # they are kept as empty elements with the same label
+        markers = ''.join(
+            f'<span epub:type="pagebreak" id={quoteattr(ref)} aria-label={quoteattr(label)}></span>'
+            for _, ref, label in get_pages(item)
+        )
+        self.out.writestr(f'{self.book.FOLDER_NAME}/{item.file_name}', item.get_content())
+        self._written.add(item.file_name)
+        item.content = f'<html><body><div>{markers}</div></body></html>'
+
+    def _write_items(self) -> None:
+        for item in self.book.get_items():
+            if item.file_name in self._written:
+                continue
+            if isinstance(item, epub.EpubNcx):
+                content = self._get_ncx()
+            elif isinstance(item, epub.EpubNav):
+                content = self._get_nav(item)
+            else:
+                content = item.get_content()
+            name = f'{self.book.FOLDER_NAME}/{item.file_name}' if item.manifest else item.file_name
+            self.out.writestr(name, content)
+
+    def close(self) -> None:
+        self._write_opf()
+        self._write_items()
+        self.out.close()
+
+
+@dataclass(slots=True)
+class PageTask:
+    """
+    Text of a page with everything its rendering needs from the rest of the book, so it can be
+    rendered in another process
+    """
+
+    text: str
+    # Chapters that start in the page, with their depth in the TOC
+    chapters: dict[str, int]
+    update_hamesh: bool
+
+
+def render_page(task: PageTask) -> str:
+    """
+    Render the text of a page, with its color styles already replaced with classes: special characters
+    are expanded, chapter titles become headers and, with update_hamesh, footnotes are linked
+    """
+    text = task.text.translate(SPECIAL_CHARACTERS_TABLE)
+    if task.chapters:
+        text = EpubItemExporter.replace_titles_with_headers(task.chapters, text, task.chapters)
+    if task.update_hamesh:
+        text = EpubItemExporter._update_hamesh(text)
+    return text
+
+
+def render_pages(tasks: Iterable[PageTask]) -> list[str]:
+    return [render_page(task) for task in tasks]
 
 
 class EpubItemExporter(BaseItemExporter):
     def __init__(
-        self, file: BytesIO | BinaryIO, update_hamesh: bool = False, **kwargs: Any
+        self,
+        file: BytesIO | BinaryIO,
+        update_hamesh: bool = False,
+        stream: bool = False,
+        executor: Executor | None = None,
+        **kwargs: Any,
     ) -> None:
         super().__init__(**kwargs)
         self.file = file
         self.book = epub.EpubBook()
         self.update_hamesh = update_hamesh
+        self.stream = stream
+        self.executor = executor
+        self._writer: StreamingEpubWriter | None = None
         self._pages_count: int = 0
         self._zfill_length = 0
         self._pages: list[epub.EpubHtml] = []
@@ -61,31 +152,36 @@ class EpubItemExporter(BaseItemExporter):
         self._sections_map: dict[str, epub.Link] = {}
         self._toc: list[str] = []
         self._default_css: epub.EpubItem = epub.EpubItem()
-        self._color_styles_map: dict[str, int] = {}
-        self._last_color_id: int = 0
+        # Color style to class, in order of first use in the book, the stylesheet is written from it
+        self._color_styles_map: dict[str, str] = {}
+
+    def _color_class(self, match: re.Match) -> str:
+        style = match.group(1)
+        if (color_class := self._color_styles_map.get(style)) is None:
+            color_class = self._color_styles_map[style] = f'color-{len(self._color_styles_map) + 1}'
+        return f'class="{color_class}"'
 
     def replace_color_styles_with_class(self, html_str: str) -> str:
-        matches = CSS_STYLE_COLOR_PATTERN.findall(html_str)
-        if not matches:
-            return html_str
-        for style in list(set(CSS_STYLE_COLOR_PATTERN.findall(html_str))):
-            color_class = self._color_styles_map.get(style, '')
-            if not color_class:
-                color_class = f'color-{self._last_color_id + 1}'
-                self._color_styles_map.update({style: color_class})
-                self._last_color_id += 1
-                self._default_css.content += f'\n.{color_class} {{ {style}; }}\n\n'
-            html_str = re.sub(f'style="{style}"', f'class="{color_class}"', html_str)
-        return html_str
+        replaced: str = CSS_STYLE_COLOR_PATTERN.sub(self._color_class, html_str)
+        return replaced
+
+    def _stylesheet(self) -> str:
+        return EPUB_CSS + ''.join(
+            f'\n.{color_class} {{ {style}; }}\n\n'
+            for style, color_class in self._color_styles_map.items()
+        )
 
     @staticmethod
-    def _get_hamesh_items(hamesh: SelectorList) -> dict[int, Element]:
-        #  <aside id="fn1" epub:type="footnote">
-        #  <p><a href="#fnref1" title="footnote 1">[1]</a> Text in popup</p>
-        #  </aside>
-        hamesh_items: dict[int, Element] = {}
+    def _get_hamesh_items(hamesh: list[str]) -> dict[int, str]:
+        """
+        Footnotes of the hamesh by number, the continuation of the last footnote of the previous page
+        is number 0
+        :param hamesh: HTML of the hamesh elements
+        :return: footnotes HTML
+        """
+        hamesh_items: dict[int, str] = {}
         hamesh_counter = 0
-        for hamesh_item in hamesh.getall():
+        for hamesh_item in hamesh:
             _hamesh_item = hamesh_item
             if hamesh_continuation := HAMESH_CONTINUATION_PATTERN.search(hamesh_item):
                 hamesh_text = f'{hamesh_continuation.group("continuation")}<br>'
@@ -93,107 +189,112 @@ class EpubItemExporter(BaseItemExporter):
                     if ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN.match(p):
                         break
                     hamesh_text += f'{p}<br>'
-                aside = Element('aside', {'id': f'fn{hamesh_counter}', EPUB_TYPE: 'footnote'})
-                span = Element('span')
-                span.text = hamesh_text.strip()
-                aside.append(span)
                 # ٠ Arabic-Indic Digit Zero # noqa: RUF003
-                hamesh_items.update({0: aside})
+                hamesh_items[0] = CONTINUED_FOOTNOTE.format(
+                    count=hamesh_counter, text=hamesh_text.strip()
+                )
                 _hamesh_item = _hamesh_item.replace(hamesh_text, '')
             for match in HAMESH_PATTERN.finditer(_hamesh_item):
                 hamesh_counter += 1
-                current_hamesh = match.group('number').strip()
-                hamesh_line = match.group('content').strip()
-                aside = Element('aside', {'id': f'fn{hamesh_counter}', EPUB_TYPE: 'footnote'})
-                span = Element('span')
-                a = Element('a', {'href': f'#fnref{hamesh_counter}', 'class': 'nu'})
-                a.text = current_hamesh
-                span.text = ' ' + hamesh_line.strip()
-                aside.append(a)
-                aside.append(span)
-                hamesh_items.update({hamesh_counter: aside})
+                hamesh_items[hamesh_counter] = FOOTNOTE.format(
+                    count=hamesh_counter,
+                    number=match.group('number').strip(),
+                    text=match.group('content').strip(),
+                )
         return hamesh_items
 
     @staticmethod
-    def _is_aya_match(text: str, match: re.Match, number: str) -> bool:
-        aya_match = ARABIC_NUMBER_BETWEEN_CURLY_BRACES_PATTERN.search(text)
-        return bool(
-            aya_match
-            and number in aya_match.group()
-            # number is inside aya
-            and match.start('number') > aya_match.start()
-        )
+    def _link_paragraph(
+        paragraph: str, hamesh_items: dict[int, str], footnote_count: int, footnotes: list[str]
+    ) -> tuple[str, int]:
+        """
+        Link the bracketed numbers of a paragraph to the next footnotes, in order
+        :param paragraph: paragraph HTML
+        :param hamesh_items: footnotes by number
+        :param footnote_count: number of the next footnote
+        :param footnotes: linked footnotes, the footnotes linked in the paragraph are appended to it
+        :return: linked paragraph HTML and number of the next footnote
+        """
+        # Ayahs are masked, so their numbers are not linked
+        ayahs: list[str] = []
 
-    @staticmethod
-    def _create_footnote_link(footnote_count: int, number: str) -> Element:
-        footnote_link: Element = Element(
-            'a',
-            {
-                'href': f'#fn{footnote_count}',
-                EPUB_TYPE: 'noteref',
-                'role': 'doc-noteref',
-                'id': f'fnref{footnote_count}',
-                # "title": f"هامش {footnote_count}",
-                'class': 'fn nu',
-            },
-        )
-        footnote_link.text = number
-        return footnote_link
+        def mask_ayah(match: re.Match) -> str:
+            ayahs.append(match.group())
+            return f'\x00{len(ayahs) - 1}\x00'
 
-    def _update_hamesh(self, content: Selector) -> Selector:  # noqa: C901, PLR0912
-        new_content = content.css('div').get('')
-        hamesh: SelectorList = content.css('.hamesh')
+        text = AYAH_PATTERN.sub(mask_ayah, paragraph)
+        # A number in the first curly braces, or repeated after them, is part of an ayah
+        ayah_braces = ARABIC_NUMBER_BETWEEN_CURLY_BRACES_PATTERN.search(text)
+        parts: list[str] = []
+        position = 0
+        for match in ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN.finditer(text):
+            if footnote_count not in hamesh_items:
+                break
+            number = match.group('number')
+            if (
+                ayah_braces
+                and number in ayah_braces.group()
+                and match.start('number') > ayah_braces.start()
+            ):
+                continue
+            link = FOOTNOTE_LINK.format(count=footnote_count, number=number)
+            parts += (text[position : match.start()], link)
+            position = match.end()
+            footnotes.append(hamesh_items[footnote_count])
+            footnote_count += 1
+        if not parts:
+            return paragraph, footnote_count
+        parts.append(text[position:])
+        linked = ''.join(parts)
+        if ayahs:
+            linked = AYAH_PLACEHOLDER_PATTERN.sub(lambda match: ayahs[int(match.group(1))], linked)
+        return linked, footnote_count
+
+    @classmethod
+    def _update_hamesh(cls, html: str) -> str:
+        """
+        Link the footnote numbers of a page to its hamesh. The page is parsed once, its paragraphs
+        are found in a single scan of the serialized page and the linked page is written in one pass.
+        :param html: page HTML
+        :return: page div HTML
+        """
+        content = Selector(text=html)
+        page = content.css('div').get('')
+        hamesh = content.css('.hamesh').getall()
         if not hamesh:
-            return content
-        hamesh_items: dict[int, Element] = self._get_hamesh_items(hamesh)
-        new_hamesh: Element = Element('div', {'class': 'hamesh'})
-        hamesh_continuation = hamesh_items.pop(0, None)
-        if hamesh_continuation is not None:
-            new_hamesh.append(hamesh_continuation)
-        p_elements: SelectorList = content.css('p:not(.hamesh)')
-        # extract ayah text to avoid wrong replacements
-        aya_matches = AYAH_PATTERN.findall(''.join(p_elements.getall()))
-        if aya_matches:
-            for idx, aya in enumerate(aya_matches, start=1):
-                new_content = new_content.replace(aya, f'PLACEHOLDER_{idx}')
-            p_elements = Selector(text=new_content).css('p:not(.hamesh)')
+            return page
+        hamesh_items = cls._get_hamesh_items(hamesh)
+        footnotes = [hamesh_items.pop(0)] if 0 in hamesh_items else []
+        # (start, end, replacement) of the page spans
+        edits: list[tuple[int, int, str]] = []
         footnote_count = 1
-        p_replacements = []
-        for p in p_elements:
-            p_text = p.get()
-            matches = ARABIC_NUMBER_BETWEEN_BRACKETS_PATTERN.finditer(p_text)
-            replacements = []
-            for match in matches:
-                number = match.group('number')
-                if hamesh_items.get(footnote_count) is None:
-                    continue
-                if self._is_aya_match(p_text, match, number):
-                    continue
-                replacements.append(
-                    (
-                        match.start(),
-                        match.end(),
-                        self.element_as_text(self._create_footnote_link(footnote_count, number)),
-                    )
-                )
-                new_hamesh.append(hamesh_items[footnote_count])
-                footnote_count += 1
-            if replacements:
-                for start, end, replacement in reversed(replacements):
-                    p_text = p_text[:start] + replacement + p_text[end:]
-                p_replacements.append((p.get(), p_text))
-        for original, replacement in reversed(p_replacements):
-            new_content = new_content.replace(original, replacement)
-        if aya_matches:
-            for idx, aya in enumerate(aya_matches, start=1):
-                new_content = new_content.replace(f'PLACEHOLDER_{idx}', aya)
-        return Selector(text=new_content.replace(hamesh.get(''), self.element_as_text(new_hamesh)))
-
-    @staticmethod
-    def element_as_text(element: Element) -> str:
-        element_text: str = tostring(element, encoding='utf-8').decode()
-        assert isinstance(element_text, str)
-        return unescape(element_text)
+        for paragraph in PARAGRAPH_PATTERN.finditer(page):
+            if footnote_count not in hamesh_items:
+                break
+            if HAMESH_CLASS_PATTERN.search(paragraph.group('attributes') or ''):
+                continue
+            original = paragraph.group()
+            linked, footnote_count = cls._link_paragraph(
+                original, hamesh_items, footnote_count, footnotes
+            )
+            if linked != original:
+                edits.append((paragraph.start(), paragraph.end(), linked))
+        if (start := page.find(hamesh[0])) != -1:
+            new_hamesh = (
+                f'<div class="hamesh">{"".join(footnotes)}</div>'
+                if footnotes
+                else '<div class="hamesh"/>'
+            )
+            edits.append((start, start + len(hamesh[0]), new_hamesh))
+        parts: list[str] = []
+        position = 0
+        for start, end, replacement in sorted(edits):
+            if start < position:
+                continue
+            parts += (page[position:start], replacement)
+            position = end
+        parts.append(page[position:])
+        return Selector(text=''.join(parts)).css('div').get('')
 
     def create_toc_depth_map(
         self, toc: list[dict[str, Any]], depth_map: dict[str, int] | None = None, depth: int = 1
@@ -209,7 +310,7 @@ class EpubItemExporter(BaseItemExporter):
 
     @staticmethod
     def replace_titles_with_headers(
-        chapters_in_page: dict[str, list[str]], text: str, toc_depth_map: dict[str, int]
+        chapters_in_page: Iterable[str], text: str, toc_depth_map: dict[str, int]
     ) -> str:
         for title in chapters_in_page:
             if f'[{title}]' not in text:
@@ -223,7 +324,7 @@ class EpubItemExporter(BaseItemExporter):
                 )
         return text
 
-    def add_chapter(self, chapters_in_page: dict[str, list[str]], page_filename: str) -> None:
+    def add_chapter(self, chapters_in_page: list[str], page_filename: str) -> None:
         for i in chapters_in_page:
             link = epub.Link(
                 page_filename,
@@ -270,7 +371,67 @@ class EpubItemExporter(BaseItemExporter):
             content=EPUB_CSS,
         )
         self.book.add_item(self._default_css)
+        if self.stream:
+            self._writer = StreamingEpubWriter(self.file, self.book)
 
+    def _add_page(self, page: epub.EpubHtml) -> None:
+        self.book.add_item(page)
+        self._pages.append(page)
+        if self._writer is not None:
+            self._writer.write_document(page)
+
+    def _page_task(
+        self,
+        page: dict[str, Any],
+        info: dict[str, Any],
+        toc_depth_map: dict[str, int],
+        volume_index: VolumeIndex,
+    ) -> tuple[tuple[str, str, list[str], str], PageTask]:
+        """
+        Prepare the rendering of a page. The color styles are replaced here, in pages order, so the
+        color classes don't depend on where the pages are rendered.
+        :return: file name, title, chapters and footer of the page, and its rendering task
+        """
+        page_title = ''
+        if chapters_in_page := info['page_chapters'].get(page['page_number']):
+            page_title = chapters_in_page[0]
+        page_volume_idx, page_volume = volume_index.find(page['page_number']) or (1, '')
+        page_filename = (
+            f'page{"_" if page_volume else ""}{page_volume_idx}_'
+            f'{str(page["page_number"]).zfill(self._zfill_length)}.xhtml'
+        )
+        footer = ''
+        if page_volume:
+            footer += f'الجزء: {page_volume} - '
+        footer += f'الصفحة: {page["page"]}'
+        task = PageTask(
+            self.replace_color_styles_with_class(page['text']),
+            {title: toc_depth_map.get(title, 2) for title in chapters_in_page or ()},
+            self.update_hamesh,
+        )
+        return (page_filename, page_title, chapters_in_page or [], footer), task
+
+    def _render_pages[T](self, tasks: Iterable[tuple[T, PageTask]]) -> Iterator[tuple[T, str]]:
+        """
+        Render the pages in order, in the executor processes when there is one. Only
+        RENDER_BATCHES_AHEAD batches are submitted ahead, so the pages are still read one batch at a time.
+        """
+        if self.executor is None:
+            for key, task in tasks:
+                yield key, render_page(task)
+            return
+        pending: deque[tuple[tuple[T, ...], Future[list[str]]]] = deque()
+        for batch in batched(tasks, RENDER_BATCH_SIZE, strict=False):
+            keys, page_tasks = zip(*batch, strict=True)
+            pending.append((keys, self.executor.submit(render_pages, page_tasks)))
+            if len(pending) > RENDER_BATCHES_AHEAD:
+                keys, future = pending.popleft()
+                yield from zip(keys, future.result(), strict=True)
+        while pending:
+            keys, future = pending.popleft()
+            yield from zip(keys, future.result(), strict=True)
+
+    @timed
     def export_item(self, item: dict[str, Any]) -> dict[str, Any]:
         info, pages = item.values()
         # set pages count from last page number
@@ -286,41 +447,14 @@ class EpubItemExporter(BaseItemExporter):
             content=f'<html><body>{info["about"]}</body></html>',
         )
         info_page.add_item(self._default_css)
-        self.book.add_item(info_page)
-        self._pages.append(info_page)
+        self._add_page(info_page)
         toc_depth_map = self.create_toc_depth_map(info['toc'])
         # pages
-        for page in pages:
-            page_title = ''
-            if chapters_in_page := info['page_chapters'].get(page['page_number']):
-                page_title = chapters_in_page[0]
-            # get page volume
-            page_volume_idx, page_volume = next(
-                (
-                    (index, k)
-                    for index, (k, v) in enumerate(info['volumes'].items())
-                    if v[0] <= page['page_number'] <= v[1]
-                ),
-                (1, ''),
-            )
-            page_filename = (
-                f'page{"_" if page_volume else ""}{page_volume_idx}_'
-                f'{str(page["page_number"]).zfill(self._zfill_length)}.xhtml'
-            )
-            footer = ''
-            if page_volume:
-                footer += f'الجزء: {page_volume} - '
-            footer += f'الصفحة: {page["page"]}'
-            text = self.replace_color_styles_with_class(page['text'])
-            text = SPECIAL_CHARACTERS_PATTERN.sub(
-                lambda match: SPECIAL_CHARACTERS[match.group(0)], text
-            )
-            if chapters_in_page:
-                text = self.replace_titles_with_headers(chapters_in_page, text, toc_depth_map)
-                self.add_chapter(chapters_in_page, page_filename)
-            content = Selector(text=text)
-            if self.update_hamesh:
-                text = self._update_hamesh(content).css('div').get()
+        volume_index = VolumeIndex(info['volumes'])
+        tasks = (self._page_task(page, info, toc_depth_map, volume_index) for page in pages)
+        for (page_filename, page_title, chapters, footer), text in self._render_pages(tasks):
+            if chapters:
+                self.add_chapter(chapters, page_filename)
             new_page = epub.EpubHtml(
                 title=page_title,
                 file_name=page_filename,
@@ -328,10 +462,14 @@ class EpubItemExporter(BaseItemExporter):
                 content=f'<html><body>{text}<div class="text-center">{footer}</div></body></html>',
             )
             new_page.add_item(self._default_css)
-            self.book.add_item(new_page)
-            self._pages.append(new_page)
+            self._add_page(new_page)
         self.generate_toc(info['toc'])
         return item
 
+    @timed
     def finish_exporting(self) -> None:
-        epub.write_epub(self.file, self.book)
+        self._default_css.content = self._stylesheet()
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            epub.write_epub(self.file, self.book)
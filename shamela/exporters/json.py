@@ -1,21 +1,239 @@
+import argparse
+import heapq
 import json
+import pickle
+import sys
+import tempfile
+from collections.abc import Iterable, Iterator
 from io import BytesIO
-from typing import Any, BinaryIO
+from itertools import islice
+from operator import itemgetter
+from types import ModuleType
+from typing import IO, Any, BinaryIO, cast
 
 from scrapy.exporters import JsonItemExporter
 
+orjson: ModuleType | None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Items kept in memory by SortedJsonItemExporter before a sorted run is written to a temporary file
+SORT_BUFFER_SIZE = 10_000
+# Items pickled together in a run, and serialized together in the output
+BLOCK_SIZE = 500
+
+
+class ExternalSorter:
+    """
+    Sort items by key with bounded memory. Items are buffered up to buffer_size, then written as a
+    sorted run of pickled blocks to a temporary file, and the runs are merged when iterating, with
+    one block of each run in memory. Items with equal keys keep their insertion order.
+    """
+
+    def __init__(self, buffer_size: int = SORT_BUFFER_SIZE) -> None:
+        self.buffer_size = buffer_size
+        self._buffer: list[tuple[Any, Any]] = []
+        self._runs: list[IO[bytes]] = []
+
+    def add(self, key: Any, item: Any) -> None:
+        self._buffer.append((key, item))
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    def _spill(self) -> None:
+        self._buffer.sort(key=itemgetter(0))
+        run = tempfile.TemporaryFile()  # noqa: SIM115, closed by close()
+        for i in range(0, len(self._buffer), BLOCK_SIZE):
+            pickle.dump(self._buffer[i : i + BLOCK_SIZE], run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self._runs.append(run)
+        self._buffer = []
+
+    @staticmethod
+    def _read(run: IO[bytes]) -> Iterator[tuple[Any, Any]]:
+        while True:
+            try:
+                block = pickle.load(run)  # noqa: S301
+            except EOFError:
+                return
+            yield from block
+
+    def __iter__(self) -> Iterator[Any]:
+        self._buffer.sort(key=itemgetter(0))
+        if not self._runs:
+            return map(itemgetter(1), self._buffer)
+        runs = [self._read(run) for run in self._runs]
+        return map(itemgetter(1), heapq.merge(*runs, self._buffer, key=itemgetter(0)))
+
+    def close(self) -> None:
+        for run in self._runs:
+            run.close()
+        self._runs, self._buffer = [], []
+
+
+def write_array(file: BytesIO | BinaryIO, items: Iterable[Any]) -> None:
+    """
+    Write items as the same JSON array as json.dumps(items, ensure_ascii=False, indent=1), with
+    BLOCK_SIZE items serialized at a time
+    """
+    iterator = iter(items)
+    separator = b'[\n'
+    while block := list(islice(iterator, BLOCK_SIZE)):
+        # Without the brackets of the block array, its items are already indented
+        text = json.dumps(block, ensure_ascii=False, indent=1)[2:-2]
+        file.write(separator + text.encode('utf-8'))
+        separator = b',\n'
+    file.write(b'[]' if separator == b'[\n' else b'\n]')
+
 
 class SortedJsonItemExporter(JsonItemExporter):
-    def __init__(self, file: BytesIO | BinaryIO, **kwargs: Any) -> None:
+    """
+    Export items as a JSON array sorted by ID, with an external merge sort so only
+    sort_buffer_size items are kept in memory
+    """
+
+    def __init__(
+        self, file: BytesIO | BinaryIO, sort_buffer_size: int = SORT_BUFFER_SIZE, **kwargs: Any
+    ) -> None:
         super().__init__(file, **kwargs)
-        self._items: list[dict[str, Any]] = []
+        self._sorter = ExternalSorter(sort_buffer_size)
 
     def export_item(self, item: dict[str, Any]) -> None:
-        self._items.append(dict(self._get_serialized_fields(item)))
+        fields = dict(self._get_serialized_fields(item))
+        self._sorter.add(fields.get('id', 0), fields)
 
     def start_exporting(self) -> None:
         pass
 
     def finish_exporting(self) -> None:
-        self._items.sort(key=lambda x: x.get('id', 0))
-        self.file.write(json.dumps(self._items, ensure_ascii=False, indent=1).encode('utf-8'))
+        try:
+            write_array(self.file, self._sorter)
+        finally:
+            self._sorter.close()
+
+
+_compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def json_compact_dumps(value: Any) -> bytes:
+    """
+    Serialize a value as compact UTF-8 JSON
+    """
+    return _compact_encoder.encode(value).encode('utf-8')
+
+
+def orjson_compact_dumps(value: Any) -> bytes:
+    """
+    Serialize a value as the same compact UTF-8 JSON as json_compact_dumps, without an intermediate str
+    """
+    assert orjson is not None
+    dumped: bytes = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return dumped
+
+
+compact_dumps = json_compact_dumps if orjson is None else orjson_compact_dumps
+
+
+class BookJsonItemExporter(JsonItemExporter):
+    """
+    Write a book item with the same layout as SortedJsonItemExporter, one page at a time,
+    so the book pages can be streamed from a PageStore without loading them into memory.
+    With compact, the JSON has no whitespace and is serialized with orjson when it is installed.
+    """
+
+    def __init__(self, file: BinaryIO, compact: bool = False, **kwargs: Any) -> None:
+        # JsonItemExporter only writes bytes to the file, whatever binary file it is
+        super().__init__(cast(BytesIO, file), **kwargs)
+        self.compact = compact
+
+    # Overridden to compare the serializers
+    compact_dumps = staticmethod(compact_dumps)
+
+    def _dumps(self, value: Any, level: int) -> bytes:
+        if self.compact:
+            return self.compact_dumps(value)
+        text = json.dumps(value, ensure_ascii=False, indent=1)
+        return text.replace('\n', '\n' + ' ' * level).encode('utf-8')
+
+    def _indent(self, level: int) -> bytes:
+        return b'' if self.compact else b'\n' + b' ' * level
+
+    def export_item(self, item: dict[str, Any]) -> None:
+        fields = list(self._get_serialized_fields(item))
+        colon = b':' if self.compact else b': '
+        self.file.write(b'[' + self._indent(1) + b'{')
+        for index, (name, value) in enumerate(fields):
+            self.file.write(self._indent(2) + self._dumps(name, 2) + colon)
+            if name == 'pages':
+                self._write_pages(value)
+            else:
+                self.file.write(self._dumps(value, 2))
+            if index < len(fields) - 1:
+                self.file.write(b',')
+        self.file.write(self._indent(1) + b'}' if fields else b'}')
+
+    def _write_pages(self, pages: Iterable[dict[str, Any]]) -> None:
+        self.file.write(b'[')
+        indent = self._indent(3)
+        separator = indent
+        for page in pages:
+            self.file.write(separator + self._dumps(page, 3))
+            separator = b',' + indent
+        # empty list is written as []
+        if separator != indent:
+            self.file.write(self._indent(2))
+        self.file.write(b']')
+
+    def start_exporting(self) -> None:
+        pass
+
+    def finish_exporting(self) -> None:
+        self.file.write(self._indent(0) + b']')
+
+
+def sort_json_lines(
+    source: IO[bytes], file: BytesIO | BinaryIO, buffer_size: int = SORT_BUFFER_SIZE
+) -> int:
+    """
+    Sort a JSON lines feed by ID into the JSON array written by SortedJsonItemExporter
+    :param source: JSON lines file
+    :param file: output file
+    :param buffer_size: maximum number of items in memory
+    :return: number of items
+    """
+    sorter = ExternalSorter(buffer_size)
+    count = 0
+    try:
+        for line in source:
+            if line.strip():
+                item = json.loads(line)
+                sorter.add(item.get('id', 0), item)
+                count += 1
+        write_array(file, sorter)
+    finally:
+        sorter.close()
+    return count
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description='Sort a JSON lines feed by ID into a JSON array, with bounded memory'
+    )
+    parser.add_argument('source', type=argparse.FileType('rb'), help='JSON lines feed')
+    parser.add_argument('output', type=argparse.FileType('wb'), help='sorted JSON file')
+    parser.add_argument(
+        '--buffer-size',
+        type=int,
+        default=SORT_BUFFER_SIZE,
+        help=f'maximum number of items in memory (default: {SORT_BUFFER_SIZE})',
+    )
+    args = parser.parse_args()
+    with args.source, args.output:
+        count = sort_json_lines(args.source, args.output, args.buffer_size)
+    sys.stdout.write(f'Sorted {count} items\n')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,455 @@
+"""
+HTTP cache storage in a single SQLite file per spider, with compressed bodies, and a cache policy
+that revalidates expired responses instead of downloading them again.
+Manage the cache with `python -m shamela.httpcache`.
+"""
+
+import argparse
+import gzip
+import logging
+import pickle
+import sys
+import time
+import zlib
+from collections.abc import Callable, Iterator
+from http import HTTPStatus
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+from scrapy import Spider
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers, Request, Response
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import BaseSettings
+from scrapy.utils import project
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import data_path
+from sqlalchemy import (
+    Column,
+    Float,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    delete,
+    func,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from shamela.db import create_db_engine, sqlite_pragmas
+
+zstandard: ModuleType | None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+responses_table = Table(
+    'responses',
+    metadata,
+    # Hex request fingerprint, as the directory names of FilesystemCacheStorage
+    Column('fingerprint', String, primary_key=True),
+    Column('url', String),
+    Column('status', Integer),
+    Column('headers', LargeBinary),
+    Column('body', LargeBinary),
+    Column('codec', String),
+    Column('timestamp', Float),
+    Index('ix_responses_timestamp', 'timestamp'),
+)
+
+
+def compressor(codec: str, level: int) -> Callable[[bytes], bytes]:
+    # ResponseCache falls back to zlib when zstandard is not installed
+    if codec == 'zstd' and zstandard is not None:
+        compress: Callable[[bytes], bytes] = zstandard.ZstdCompressor(level=level).compress
+        return compress
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, level)
+    return lambda data: data
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError(
+                'zstandard is not installed, zstd compressed responses cannot be read'
+            )
+        decompressed: bytes = zstandard.ZstdDecompressor().decompress(data)
+        return decompressed
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+class ResponseCache:
+    """
+    Single-file store of responses keyed by request fingerprint.
+    Writes are committed in batches, pending responses are read back before they are committed.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        codec: str = 'zlib',
+        level: int = 3,
+        batch_size: int = 100,
+        pragmas: dict[str, Any] | None = None,
+    ) -> None:
+        if codec == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed, compressing the HTTP cache with zlib')
+            codec = 'zlib'
+        self.path = Path(path)
+        self.codec = codec
+        self.compress = compressor(codec, level)
+        self.batch_size = batch_size
+        self.engine = create_db_engine(f'sqlite:///{self.path}', pragmas)
+        metadata.create_all(self.engine)
+        self.connection = self.engine.connect()
+        self._pending: dict[str, dict[str, Any]] = {}
+        # Built once, get is called for every request of a crawl
+        self._select = select(responses_table).where(
+            responses_table.c.fingerprint == bindparam('fingerprint')
+        )
+
+    def get(self, fingerprint: str) -> dict[str, Any] | None:
+        """
+        Get a cached response
+        :param fingerprint: hex request fingerprint
+        :return: dict of url, status, raw headers, body and timestamp, or None if it is not cached
+        """
+        row = self._pending.get(fingerprint)
+        if row is None:
+            result = self.connection.execute(self._select, {'fingerprint': fingerprint}).first()
+            if result is None:
+                return None
+            row = dict(result._mapping)
+        return {**row, 'body': decompress(row['codec'], row['body'])}
+
+    def put(  # noqa: PLR0913
+        self,
+        fingerprint: str,
+        url: str,
+        status: int,
+        headers: bytes,
+        body: bytes,
+        timestamp: float | None = None,
+    ) -> None:
+        self._pending[fingerprint] = {
+            'fingerprint': fingerprint,
+            'url': url,
+            'status': status,
+            'headers': headers,
+            'body': self.compress(body),
+            'codec': self.codec,
+            'timestamp': time.time() if timestamp is None else timestamp,
+        }
+        if len(self._pending) >= self.batch_size:
+            self.commit()
+
+    def touch(self, fingerprint: str, timestamp: float | None = None) -> None:
+        """
+        Mark a cached response as fresh again, without rewriting its body
+        :param fingerprint: hex request fingerprint
+        :param timestamp: new timestamp, now by default
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if fingerprint in self._pending:
+            self._pending[fingerprint]['timestamp'] = timestamp
+        else:
+            self.connection.execute(
+                update(responses_table)
+                .where(responses_table.c.fingerprint == fingerprint)
+                .values(timestamp=timestamp)
+            )
+
+    def commit(self) -> None:
+        if self._pending:
+            statement = insert(responses_table)
+            self.connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=['fingerprint'],
+                    set_={
+                        c.name: statement.excluded[c.name]
+                        for c in responses_table.columns
+                        if not c.primary_key
+                    },
+                ),
+                list(self._pending.values()),
+            )
+            self._pending = {}
+        self.connection.commit()
+
+    def expire(self, max_age: float) -> int:
+        """
+        Delete the responses older than max_age in one statement
+        :param max_age: maximum age in seconds
+        :return: number of deleted responses
+        """
+        self.commit()
+        result = self.connection.execute(
+            delete(responses_table).where(responses_table.c.timestamp < time.time() - max_age)
+        )
+        self.connection.commit()
+        return result.rowcount
+
+    def vacuum(self) -> None:
+        """
+        Give the space of deleted responses back to the file system
+        """
+        self.commit()
+        self.connection.execute(text('VACUUM'))
+
+    def __len__(self) -> int:
+        self.commit()
+        count: int = self.connection.execute(
+            select(func.count()).select_from(responses_table)
+        ).scalar_one()
+        return count
+
+    def urls(self) -> Iterator[tuple[str, str]]:
+        """
+        Iterate over the fingerprints and URLs of the cached responses
+        """
+        self.commit()
+        for row in self.connection.execute(
+            select(responses_table.c.fingerprint, responses_table.c.url)
+        ):
+            yield row.fingerprint, row.url
+
+    def size(self) -> int:
+        """
+        Size of the cache on disk in bytes, including the write-ahead log
+        """
+        return sum(
+            path.stat().st_size
+            for path in (self.path, Path(f'{self.path}-wal'), Path(f'{self.path}-shm'))
+            if path.exists()
+        )
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+        self.engine.dispose()
+
+
+def cache_path(settings: BaseSettings, spider_name: str) -> Path:
+    return Path(data_path(settings['HTTPCACHE_DIR'], createdir=True), f'{spider_name}.db')
+
+
+def cache_from_settings(settings: BaseSettings, spider_name: str) -> ResponseCache:
+    return ResponseCache(
+        cache_path(settings, spider_name),
+        settings.get('HTTPCACHE_COMPRESSION', 'zlib'),
+        settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 3),
+        pragmas=sqlite_pragmas(settings),
+    )
+
+
+class SqliteCacheStorage:
+    """
+    HTTP cache storage backed by a ResponseCache, instead of the several files per response of
+    FilesystemCacheStorage. The size of the cache on disk is recorded in the `httpcache/size` stat.
+    With RevalidatingPolicy, expired responses are retrieved with the `stale` flag to be revalidated.
+    """
+
+    def __init__(self, settings: BaseSettings) -> None:
+        self.settings = settings
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.revalidate = issubclass(load_object(settings['HTTPCACHE_POLICY']), RevalidatingPolicy)
+        self.cache: ResponseCache | None = None
+
+    def open_spider(self, spider: Spider) -> None:
+        self.cache = cache_from_settings(self.settings, spider.name)
+        logger.debug(f'Using SQLite cache storage in {self.cache.path}', extra={'spider': spider})
+        assert spider.crawler.request_fingerprinter
+        assert spider.crawler.stats
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        self._stats = spider.crawler.stats
+
+    def close_spider(self, spider: Spider) -> None:
+        if self.cache is not None:
+            self.cache.close()
+            self._stats.set_value('httpcache/size', self.cache.size())
+
+    def retrieve_response(self, spider: Spider, request: Request) -> Response | None:
+        """Return response if present in cache, or None otherwise."""
+        if self.cache is None:
+            return None
+        data = self.cache.get(self._fingerprinter.fingerprint(request).hex())
+        if data is None:
+            return None  # not cached
+        stale = 0 < self.expiration_secs < time.time() - data['timestamp']
+        if stale and not self.revalidate:
+            return None  # expired
+        headers = Headers(headers_raw_to_dict(data['headers']))
+        response_class = responsetypes.from_args(
+            headers=headers, url=data['url'], body=data['body']
+        )
+        return response_class(
+            url=data['url'],
+            headers=headers,
+            status=data['status'],
+            body=data['body'],
+            flags=['stale'] if stale else None,
+        )
+
+    def store_response(self, spider: Spider, request: Request, response: Response) -> None:
+        """Store the given response in the cache."""
+        if self.cache is not None:
+            self.cache.put(
+                self._fingerprinter.fingerprint(request).hex(),
+                response.url,
+                response.status,
+                headers_dict_to_raw(response.headers),
+                response.body,
+            )
+
+    def touch_response(self, spider: Spider, request: Request) -> None:
+        """Mark the cached response of the given request as fresh."""
+        if self.cache is not None:
+            self.cache.touch(self._fingerprinter.fingerprint(request).hex())
+
+
+class RevalidatingPolicy(DummyPolicy):
+    """
+    Serve cached responses until they expire, then revalidate them: the request is sent with the
+    ETag and Last-Modified validators of the cached response, and the cached response is kept if
+    the server answers 304 Not Modified, or the same body when it doesn't support validators.
+    Needs a storage that retrieves expired responses, such as SqliteCacheStorage.
+    """
+
+    def should_cache_response(self, response: Response, request: Request) -> bool:
+        return response.status != HTTPStatus.NOT_MODIFIED and super().should_cache_response(
+            response, request
+        )
+
+    def is_cached_response_fresh(self, cachedresponse: Response, request: Request) -> bool:
+        if 'stale' not in cachedresponse.flags:
+            return True
+        if b'ETag' in cachedresponse.headers:
+            request.headers[b'If-None-Match'] = cachedresponse.headers[b'ETag']
+        if b'Last-Modified' in cachedresponse.headers:
+            request.headers[b'If-Modified-Since'] = cachedresponse.headers[b'Last-Modified']
+        return False
+
+    def is_cached_response_valid(
+        self, cachedresponse: Response, response: Response, request: Request
+    ) -> bool:
+        # Keep serving the stale response while the server fails
+        if response.status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            return True
+        return response.status == HTTPStatus.NOT_MODIFIED or (
+            response.status == cachedresponse.status and response.body == cachedresponse.body
+        )
+
+
+class RevalidatingCacheMiddleware(HttpCacheMiddleware):
+    """
+    HttpCacheMiddleware that marks the revalidated responses as fresh again, so they are served from
+    the cache until they expire again, and counts them in the `httpcache/revalidate/not_modified`
+    and `httpcache/revalidate/unchanged` stats.
+    """
+
+    def process_response(
+        self, request: Request, response: Response, spider: Spider
+    ) -> Request | Response:
+        cachedresponse = request.meta.get('cached_response')
+        result = super().process_response(request, response, spider)
+        if (
+            cachedresponse is not None
+            and result is cachedresponse
+            and response.status < HTTPStatus.INTERNAL_SERVER_ERROR
+        ):
+            reason = 'not_modified' if response.status == HTTPStatus.NOT_MODIFIED else 'unchanged'
+            self.stats.inc_value(f'httpcache/revalidate/{reason}', spider=spider)
+            if touch_response := getattr(self.storage, 'touch_response', None):
+                touch_response(spider, request)
+        return result
+
+
+def import_filesystem_cache(settings: BaseSettings, spider_name: str, cache: ResponseCache) -> int:
+    """
+    Import the responses of a spider stored by FilesystemCacheStorage
+    :param settings: project settings
+    :param spider_name: spider name
+    :param cache: cache to import the responses into
+    :return: number of imported responses
+    """
+    open_file: Callable[..., Any] = gzip.open if settings.getbool('HTTPCACHE_GZIP') else open
+    count = 0
+    for meta_path in Path(data_path(settings['HTTPCACHE_DIR']), spider_name).glob(
+        '*/*/pickled_meta'
+    ):
+        path = meta_path.parent
+        with open_file(meta_path, 'rb') as f:
+            meta = pickle.load(f)  # noqa: S301
+        with open_file(path / 'response_headers', 'rb') as f:
+            headers = f.read()
+        with open_file(path / 'response_body', 'rb') as f:
+            body = f.read()
+        # FilesystemCacheStorage expires responses by the modification time of their metadata
+        cache.put(
+            path.name,
+            meta['response_url'],
+            meta['status'],
+            headers,
+            body,
+            meta_path.stat().st_mtime,
+        )
+        count += 1
+    cache.commit()
+    return count
+
+
+def run() -> None:
+    settings = project.get_project_settings()
+    parser = argparse.ArgumentParser(description='Manage the SQLite HTTP cache')
+    parser.add_argument(
+        'command',
+        choices=('size', 'expire', 'import'),
+        help='size: show the cache size, expire: delete expired responses, '
+        'import: import the responses cached by FilesystemCacheStorage',
+    )
+    parser.add_argument('spiders', nargs='+', help='names of the spiders')
+    parser.add_argument(
+        '--max-age',
+        type=float,
+        default=settings.getint('HTTPCACHE_EXPIRATION_SECS'),
+        help='maximum age in seconds of the responses kept by expire '
+        '(default: HTTPCACHE_EXPIRATION_SECS)',
+    )
+    args = parser.parse_args()
+    for spider_name in args.spiders:
+        cache = cache_from_settings(settings, spider_name)
+        try:
+            if args.command == 'import':
+                count = import_filesystem_cache(settings, spider_name, cache)
+                sys.stdout.write(f'{spider_name}: imported {count} responses\n')
+            elif args.command == 'expire':
+                count = cache.expire(args.max_age)
+                cache.vacuum()
+                sys.stdout.write(f'{spider_name}: deleted {count} responses\n')
+            sys.stdout.write(
+                f'{spider_name}: {len(cache)} responses, {cache.size() / 1024 / 1024:.1f} MiB\n'
+            )
+        finally:
+            cache.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
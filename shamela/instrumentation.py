@@ -0,0 +1,367 @@
+"""
+Per-stage timings of the crawl: downloads, spider callbacks, pipelines and exporters, with queue depths
+and transferred bytes, exported periodically as JSON lines or Prometheus text.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Self
+
+from scrapy import Request, Spider, signals
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+Labels = tuple[tuple[str, str], ...]
+
+# Upper bounds in seconds, from half a millisecond to a minute
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ('count', 'counts', 'sum')
+
+    def __init__(self) -> None:
+        # The last bucket counts the values above the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket of the q quantile
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts, strict=False):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Histograms and counters of the running process, by name and labels
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.counters: dict[tuple[str, Labels], float] = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+metrics = Metrics()
+
+
+def timed[**P, R](function: Callable[P, R]) -> Callable[P, R]:
+    """
+    Record the duration of every call in the `stage_seconds` histogram, under the function qualified
+    name, while the instrumentation is enabled
+    """
+    stage = function.__qualname__
+
+    @wraps(function)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        if not metrics.enabled:
+            return function(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+
+    return wrapper
+
+
+def _callback_name(request: Request | None) -> str:
+    # Responses without a request are handled by the default callback
+    if request is None:
+        return 'parse'
+    return getattr(request.callback, '__name__', 'parse')
+
+
+class InstrumentationMiddleware:
+    """
+    Spider middleware that records the time spent in spider callbacks. The callbacks are generators,
+    so their work is timed while their results are iterated, which needs the middleware to be the
+    closest to the spider.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        if not crawler.settings.getbool('INSTRUMENTATION_ENABLED'):
+            raise NotConfigured
+        return cls()
+
+    def process_spider_output(
+        self, response: Response, result: Iterable[Any], spider: Spider
+    ) -> Iterator[Any]:
+        iterator = iter(result)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield value
+        finally:
+            self._observe(response, spider, elapsed)
+
+    async def process_spider_output_async(
+        self, response: Response, result: AsyncIterable[Any], spider: Spider
+    ) -> AsyncIterator[Any]:
+        iterator = aiter(result)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    value = await anext(iterator)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield value
+        finally:
+            self._observe(response, spider, elapsed)
+
+    @staticmethod
+    def _observe(response: Response, spider: Spider, elapsed: float) -> None:
+        metrics.observe(
+            'callback_seconds',
+            elapsed,
+            spider=spider.name,
+            callback=_callback_name(response.request),
+        )
+
+
+def render_prometheus(
+    histograms: dict[tuple[str, Labels], Histogram],
+    counters: dict[tuple[str, Labels], float],
+    gauges: dict[tuple[str, Labels], float],
+) -> str:
+    def labels_text(labels: Labels) -> str:
+        return ','.join(f'{k}="{v}"' for k, v in labels)
+
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE shamela_{name} histogram')
+        for (metric, labels), histogram in histograms.items():
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts, strict=False):
+                cumulative += count
+                lines.append(
+                    f'shamela_{name}_bucket{{{labels_text((*labels, ("le", str(bound))))}}} '
+                    f'{cumulative}'
+                )
+            lines.append(
+                f'shamela_{name}_bucket{{{labels_text((*labels, ("le", "+Inf")))}}} '
+                f'{histogram.count}'
+            )
+            lines.append(f'shamela_{name}_sum{{{labels_text(labels)}}} {histogram.sum}')
+            lines.append(f'shamela_{name}_count{{{labels_text(labels)}}} {histogram.count}')
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        for name in sorted({name for name, _ in values}):
+            lines.append(f'# TYPE shamela_{name} {kind}')
+            lines.extend(
+                f'shamela_{name}{{{labels_text(labels)}}} {value}'
+                for (metric, labels), value in values.items()
+                if metric == name
+            )
+    return '\n'.join(lines) + '\n'
+
+
+def record_json(
+    spider: Spider,
+    histograms: dict[tuple[str, Labels], Histogram],
+    counters: dict[tuple[str, Labels], float],
+    gauges: dict[tuple[str, Labels], float],
+) -> str:
+    return json.dumps(
+        {
+            'time': time.time(),
+            'spider': spider.name,
+            'histograms': [
+                {
+                    'name': name,
+                    **dict(labels),
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                }
+                for (name, labels), histogram in histograms.items()
+            ],
+            'counters': [
+                {'name': name, **dict(labels), 'value': value}
+                for (name, labels), value in counters.items()
+            ],
+            'gauges': [
+                {'name': name, **dict(labels), 'value': value}
+                for (name, labels), value in gauges.items()
+            ],
+        },
+        ensure_ascii=False,
+    )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    server: 'MetricsServer'
+
+    def do_GET(self) -> None:  # noqa: N802
+        body = self.server.text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Serve the last rendered Prometheus text, rendering happens in the reactor thread
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int]) -> None:
+        super().__init__(address, MetricsRequestHandler)
+        self.text = ''
+
+
+class Instrumentation:
+    """
+    Record the download latency and response bytes of each request, by spider and callback, and
+    export them with the spider callbacks and the `timed` stages timings, the queue depths and the
+    transferred bytes every INSTRUMENTATION_INTERVAL seconds.
+    INSTRUMENTATION_FORMAT `jsonl` appends a JSON line to INSTRUMENTATION_PATH per export, `prometheus`
+    rewrites it with the Prometheus text format. INSTRUMENTATION_PORT serves the Prometheus text too.
+    """
+
+    def __init__(self, crawler: Crawler) -> None:
+        settings = crawler.settings
+        if not settings.getbool('INSTRUMENTATION_ENABLED'):
+            raise NotConfigured
+        assert crawler.stats
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('INSTRUMENTATION_INTERVAL', 10)
+        self.format = settings.get('INSTRUMENTATION_FORMAT', 'jsonl')
+        if self.format not in ('jsonl', 'prometheus'):
+            raise ValueError(f'Unknown INSTRUMENTATION_FORMAT: {self.format}')
+        path = settings.get('INSTRUMENTATION_PATH')
+        self.path = Path(path) if path else None
+        self.port = settings.getint('INSTRUMENTATION_PORT')
+        self.server: MetricsServer | None = None
+        self.task: task.LoopingCall | None = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        return ext
+
+    def spider_opened(self, spider: Spider) -> None:
+        metrics.enabled = True
+        if self.port:
+            self.server = MetricsServer(('127.0.0.1', self.port))
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f'Serving metrics on http://127.0.0.1:{self.port}/metrics')
+        self.task = task.LoopingCall(self.export, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider: Spider, reason: str) -> None:
+        if self.task and self.task.running:
+            self.task.stop()
+        self.export(spider)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        metrics.enabled = False
+
+    def response_downloaded(self, response: Response, request: Request, spider: Spider) -> None:
+        callback = _callback_name(request)
+        if (latency := request.meta.get('download_latency')) is not None:
+            metrics.observe('download_seconds', latency, spider=spider.name, callback=callback)
+        metrics.inc(
+            'response_bytes_total', len(response.body), spider=spider.name, callback=callback
+        )
+
+    def gauges(self, spider: Spider) -> dict[tuple[str, Labels], float]:
+        stats = self.stats
+        labels: Labels = (('spider', spider.name),)
+        gauges: dict[tuple[str, Labels], float] = {
+            ('queue_depth', (*labels, ('queue', 'scheduler'))): (
+                stats.get_value('scheduler/enqueued', 0) - stats.get_value('scheduler/dequeued', 0)
+            ),
+            ('bytes', (*labels, ('direction', 'in'))): stats.get_value(
+                'downloader/response_bytes', 0
+            ),
+            ('bytes', (*labels, ('direction', 'out'))): stats.get_value(
+                'downloader/request_bytes', 0
+            ),
+        }
+        if engine := self.crawler.engine:
+            gauges[('queue_depth', (*labels, ('queue', 'downloader')))] = len(
+                engine.downloader.active
+            )
+            if scraper_slot := engine.scraper.slot:
+                gauges[('queue_depth', (*labels, ('queue', 'scraper')))] = len(scraper_slot.queue)
+                gauges[('queue_depth', (*labels, ('queue', 'pipelines')))] = (
+                    scraper_slot.itemproc_size
+                )
+        return gauges
+
+    def export(self, spider: Spider) -> None:
+        gauges = self.gauges(spider)
+        if self.server or self.format == 'prometheus':
+            text = render_prometheus(metrics.histograms, metrics.counters, gauges)
+            if self.server:
+                self.server.text = text
+        if self.path is None:
+            return
+        if self.format == 'prometheus':
+            # Replaced at once, so a collector never reads a partly written file
+            temporary = self.path.with_name(f'{self.path.name}.tmp')
+            temporary.write_text(text, encoding='utf-8')
+            temporary.replace(self.path)
+        else:
+            with self.path.open('a', encoding='utf-8') as f:
+                f.write(record_json(spider, metrics.histograms, metrics.counters, gauges) + '\n')
@@ -2,15 +2,22 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+import logging
+import time
 from collections.abc import Iterable
-from typing import Any
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Self
 
 # useful for handling different item types with a single interface
 # from itemadapter import ItemAdapter, is_item
 from scrapy import Request, Spider, signals
 from scrapy.crawler import Crawler
+from scrapy.exceptions import IgnoreRequest, NotConfigured
 from scrapy.http import Response
 
+logger = logging.getLogger(__name__)
+
 
 class ShamelaSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -108,3 +115,155 @@ class ShamelaDownloaderMiddleware:
 
     def spider_opened(self, spider: Spider) -> None:
         spider.logger.info(f'Spider opened: {spider.name}')
+
+
+@dataclass
+class SlotWindow:
+    """
+    Congestion window of a download slot, in requests in flight. Below one request, the slot sends
+    one request per `latency / window` seconds instead.
+    """
+
+    window: float
+    latency: float | None = None
+    min_latency: float | None = None
+    decreased_at: float = 0.0
+    paused_until: float = 0.0
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Adjust the concurrency and delay of each download slot with AIMD, to find the fastest rate the
+    site sustains: the window grows by one request per window of successful responses, and shrinks
+    by ADAPTIVE_CONCURRENCY_BACKOFF when a response has a RETRY_HTTP_CODES status, a download fails,
+    or the latency rises ADAPTIVE_CONCURRENCY_LATENCY_FACTOR times above the lowest latency seen.
+    Retry-After pauses the slot. The current window and delay of each slot are in the
+    `adaptive_concurrency/<slot>/window` and `adaptive_concurrency/<slot>/delay` stats.
+    """
+
+    # Smoothing of the latency moving average
+    LATENCY_SMOOTHING = 0.2
+    # Latency increase that is never a congestion signal, for sites that answer in a few milliseconds
+    LATENCY_TOLERANCE = 0.1
+    # Additive increase of a window below one request
+    DELAY_WINDOW_STEP = 0.05
+    MIN_WINDOW = 0.05
+
+    def __init__(self, crawler: Crawler) -> None:
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        assert crawler.stats
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_window = settings.getfloat(
+            'ADAPTIVE_CONCURRENCY_MAX', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        )
+        self.start_window = min(settings.getfloat('ADAPTIVE_CONCURRENCY_START', 8), self.max_window)
+        self.backoff = settings.getfloat('ADAPTIVE_CONCURRENCY_BACKOFF', 0.5)
+        self.latency_factor = settings.getfloat('ADAPTIVE_CONCURRENCY_LATENCY_FACTOR', 3)
+        self.min_delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_DELAY', 60)
+        self.congestion_codes = {int(code) for code in settings.getlist('RETRY_HTTP_CODES')}
+        self.windows: dict[str, SlotWindow] = {}
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> Self:
+        middleware = cls(crawler)
+        crawler.signals.connect(
+            middleware.request_reached_downloader, signal=signals.request_reached_downloader
+        )
+        return middleware
+
+    def request_reached_downloader(self, request: Request, spider: Spider) -> None:
+        # The slot of the first request of a host is created right before this signal
+        if key := request.meta.get('download_slot'):
+            self._apply(key)
+
+    def process_response(self, request: Request, response: Response, spider: Spider) -> Response:
+        key = request.meta.get('download_slot')
+        if key is None or 'cached' in response.flags:
+            return response
+        if response.status in self.congestion_codes:
+            self._pause(key, response.headers.get(b'Retry-After'))
+            self._decrease(key, str(response.status))
+        else:
+            self._increase(key, request.meta.get('download_latency'))
+        return response
+
+    def process_exception(self, request: Request, exception: Exception, spider: Spider) -> None:
+        if (key := request.meta.get('download_slot')) and not isinstance(exception, IgnoreRequest):
+            self._decrease(key, type(exception).__name__)
+
+    def _window(self, key: str) -> SlotWindow:
+        if key not in self.windows:
+            self.windows[key] = SlotWindow(self.start_window)
+        return self.windows[key]
+
+    def _increase(self, key: str, latency: float | None) -> None:
+        state = self._window(key)
+        if latency is not None:
+            state.latency = (
+                latency
+                if state.latency is None
+                else state.latency + (latency - state.latency) * self.LATENCY_SMOOTHING
+            )
+            # The lowest latency drifts up slowly, so it follows lasting changes of the site
+            state.min_latency = (
+                latency
+                if state.min_latency is None
+                else min(latency, state.min_latency + (latency - state.min_latency) * 0.01)
+            )
+            if state.latency > max(
+                state.min_latency * self.latency_factor,
+                state.min_latency + self.LATENCY_TOLERANCE,
+            ):
+                self._decrease(key, 'latency')
+                return
+        if state.window < 1:
+            state.window = min(state.window + self.DELAY_WINDOW_STEP, 1)
+        else:
+            state.window = min(state.window + 1 / state.window, self.max_window)
+        self._apply(key)
+
+    def _decrease(self, key: str, reason: str) -> None:
+        state = self._window(key)
+        now = time.time()
+        # Responses to requests sent before the last decrease don't reflect it yet
+        if now - state.decreased_at < (state.latency or 0):
+            return
+        state.decreased_at = now
+        state.window = max(state.window * self.backoff, self.MIN_WINDOW)
+        self.stats.inc_value(f'adaptive_concurrency/decrease/{reason}')
+        logger.debug(f'Decreased the {key} window to {state.window:.2f} ({reason})')
+        self._apply(key)
+
+    def _pause(self, key: str, retry_after: bytes | None) -> None:
+        if retry_after is None:
+            return
+        value = retry_after.decode(errors='ignore').strip()
+        if value.isdigit():
+            seconds = float(value)
+        else:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return
+        state = self._window(key)
+        state.paused_until = max(state.paused_until, time.time() + min(seconds, self.max_delay))
+        self.stats.inc_value('adaptive_concurrency/retry_after')
+        self._apply(key)
+
+    def _apply(self, key: str) -> None:
+        assert self.crawler.engine
+        state = self._window(key)
+        delay = self.min_delay
+        if state.window < 1:
+            delay = max(delay, (state.latency or 1) / state.window)
+        delay = max(min(delay, self.max_delay), state.paused_until - time.time())
+        if slot := self.crawler.engine.downloader.slots.get(key):
+            slot.concurrency = max(int(state.window), 1)
+            slot.delay = delay
+        self.stats.set_value(f'adaptive_concurrency/{key}/window', round(state.window, 2))
+        self.stats.set_value(f'adaptive_concurrency/{key}/delay', round(delay, 2))
+        self.stats.max_value(f'adaptive_concurrency/{key}/max_window', round(state.window, 2))
@@ -0,0 +1,377 @@
+"""
+Local stand-in for shamela.ws, to run the spiders end to end without network access.
+Run the server with `python -m shamela.mock_server`, and crawl it with the mock settings profile:
+`SCRAPY_SETTINGS_MODULE=shamela.mock_settings scrapy crawl book -a book_id=1-100`.
+"""
+
+import argparse
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from hashlib import sha1
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import urlparse
+
+from scrapy.utils import project
+
+from shamela.benchmarks import cached_responses
+from shamela.normalize import SPECIAL_CHARACTERS
+from shamela.spiders import SHAMELA_URL
+
+WORDS = (
+    'قَالَ',
+    'حَدَّثَنَا',
+    'أَخْبَرَنَا',
+    'عَنْ',
+    'الإِمَامُ',
+    'رَسُولُ',
+    'اللَّهِ',
+    'عَلَى',
+    'مُحَمَّدٍ',
+    'الكِتَابِ',
+    'وَالسُّنَّةِ',
+    'إِلَى',
+    'فِي',
+    'مَسْأَلَةٍ',
+    'بَابُ',
+    'العِلْمِ',
+    'ﷺ',
+    *SPECIAL_CHARACTERS,
+)
+COLORS = ('ff0000', '008000', '0000ff')
+ARABIC_DIGITS = str.maketrans('0123456789', '٠١٢٣٤٥٦٧٨٩')
+BOOK_PAGE_PATH_PATTERN = re.compile(r'^/book/(\d+)/(\d+)$')
+PATH_PATTERN = re.compile(r'^/(book|category|author)/(\d+)$')
+
+
+def arabic_number(number: int) -> str:
+    return str(number).translate(ARABIC_DIGITS)
+
+
+class MockSite:
+    """
+    Synthetic shamela.ws pages, generated deterministically from the page path.
+    Book `id` is in category `id % categories + 1` and by author `id % authors + 1`.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        books: int = 100,
+        pages: int = 50,
+        volumes: int = 1,
+        categories: int = 10,
+        authors: int = 20,
+        recorded: dict[str, bytes] | None = None,
+    ) -> None:
+        self.books = books
+        self.pages = max(pages, 2)  # Books with a single page have no last page link
+        self.volumes = max(min(volumes, self.pages), 1)
+        self.categories = categories
+        self.authors = authors
+        # Recorded responses bodies by path, served instead of the synthetic pages
+        self.recorded = recorded or {}
+
+    def render(self, path: str) -> bytes | None:
+        """
+        Render the page at a path
+        :param path: URL path
+        :return: page HTML, or None if there is no page at the path
+        """
+        if path in self.recorded:
+            return self.recorded[path]
+        html = None
+        if path == '/':
+            html = self.home()
+        elif path == '/authors':
+            html = self.authors_list()
+        elif path == '/robots.txt':
+            return b'User-agent: *\nAllow: /\n'
+        elif match := BOOK_PAGE_PATH_PATTERN.match(path):
+            html = self.book_page(int(match.group(1)), int(match.group(2)))
+        elif match := PATH_PATTERN.match(path):
+            kind, number = match.group(1), int(match.group(2))
+            html = getattr(self, kind)(number)
+        return html.encode() if html is not None else None
+
+    @staticmethod
+    def _document(body: str) -> str:
+        return (
+            '<!DOCTYPE html><html lang="ar" dir="rtl"><head><meta charset="utf-8"></head>'
+            f'<body>{body}</body></html>'
+        )
+
+    def home(self) -> str:
+        links = ''.join(
+            f'<a class="cat_title" href="/category/{i}">{arabic_number(i)} - قسم {i}</a>'
+            for i in range(1, self.categories + 1)
+        )
+        return self._document(links)
+
+    def category(self, category_id: int) -> str | None:
+        if not 1 <= category_id <= self.categories:
+            return None
+        books = ''.join(
+            f'<div class="book_item"><a class="book_title" href="/book/{i}">كتاب {i}</a>'
+            f'<a class="text-gray" href="/author/{i % self.authors + 1}">مؤلف</a>'
+            f'<p class="des">وصف الكتاب {i}\r\nعدد الصفحات: {arabic_number(self.pages)} '
+            f'عدد الأجزاء: {arabic_number(self.volumes)}</p></div>'
+            for i in range(1, self.books + 1)
+            if i % self.categories + 1 == category_id
+        )
+        return self._document(f'<h1>كتب قسم {category_id}</h1>{books}')
+
+    def authors_list(self) -> str:
+        links = ''.join(f'<a href="/author/{i}">مؤلف {i}</a>' for i in range(1, self.authors + 1))
+        return self._document(links)
+
+    def author(self, author_id: int) -> str | None:
+        if not 1 <= author_id <= self.authors:
+            return None
+        return self._document(
+            f'<h1>مؤلف {author_id}</h1><div class="heading-title">ترجمة</div>'
+            f'<div class="alert">ترجمة المؤلف {author_id}</div>'
+        )
+
+    def _volume_starts(self) -> list[int]:
+        size = self.pages // self.volumes
+        return [1 + i * size for i in range(self.volumes)]
+
+    def _chapters(self) -> list[int]:
+        return list(range(1, self.pages + 1, 10))
+
+    def book(self, book_id: int) -> str | None:
+        if not 1 <= book_id <= self.books:
+            return None
+        author_id = book_id % self.authors + 1
+        toc = ''.join(
+            f'<li><a href="/book/{book_id}/{page}">باب {page}</a></li>' for page in self._chapters()
+        )
+        return self._document(
+            f'<h1><a href="/book/{book_id}">كتاب {book_id}</a></h1>'
+            f'<div><a href="/author/{author_id}">مؤلف {author_id}</a></div>'
+            '<div class="nass margin-top-10"><div class="text-left">بحث</div>'
+            f'<p>بطاقة الكتاب {book_id}</p>'
+            f'<div class="betaka-index"><h4>فهرس الموضوعات</h4><ul>{toc}</ul></div></div>'
+        )
+
+    def _paragraph(self, rng: random.Random) -> str:
+        parts = []
+        for _ in range(rng.randint(4, 12)):
+            words = ' '.join(rng.choices(WORDS, k=rng.randint(3, 12)))
+            parts.append(
+                rng.choice(
+                    (
+                        words,
+                        f'<span class="c5">{words}</span>',
+                        f'<span style="color:#{rng.choice(COLORS)}">{words}</span>',
+                        f'<span></span>{words}',
+                    )
+                )
+            )
+        return ' '.join(parts)
+
+    def book_page(self, book_id: int, page_number: int) -> str | None:
+        if not 1 <= book_id <= self.books or not 1 <= page_number <= self.pages:
+            return None
+        rng = random.Random(f'{book_id}/{page_number}')  # noqa: S311
+        starts = self._volume_starts()
+        volume = sum(start <= page_number for start in starts)
+        parts = ''
+        if self.volumes > 1:
+            menu = ''.join(
+                f'<li><a href="/book/{book_id}/{start}#p1">{i}</a></li>'
+                for i, start in enumerate(starts, 1)
+            )
+            parts = (
+                f'<div id="fld_part_top"></div><div><button>{volume} </button>'
+                f'<ul role="menu"><li><a href="#">الأجزاء</a></li>{menu}</ul></div>'
+            )
+        navigation = f'<input id="fld_goto_bottom" value="{page_number - starts[volume - 1] + 1}">'
+        if page_number < self.pages:
+            navigation += (
+                f'<a href="/book/{book_id}/{page_number + 1}">التالي</a>'
+                f'<a href="/book/{book_id}/{self.pages}#p1">الأخير</a>'
+            )
+        footnote = f'({arabic_number(1)})'
+        paragraphs = ''.join(
+            f'<p style="font-size: 15px">{self._paragraph(rng)} {footnote}</p>'
+            for _ in range(rng.randint(2, 6))
+        )
+        chapter = ''
+        if page_number in self._chapters():
+            chapter = f'<p><span class="c2">[باب {page_number}]</span></p>'
+        hamesh = ' '.join(rng.choices(WORDS, k=8))
+        return self._document(
+            f'{parts}<div class="container">{navigation}'
+            '<div class="nass margin-top-10"><a class="btn_tag" href="#">نسخ</a>'
+            f'{chapter}{paragraphs}'
+            f'<hr width="95" align="right"><p class="hamesh">{footnote} {hamesh}</p>'
+            '</div></div>'
+        )
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Serve a MockSite with tunable latency and error rate, and log the served requests per second
+    """
+
+    daemon_threads = True
+
+    def __init__(  # noqa: PLR0913
+        self,
+        address: tuple[str, int],
+        site: MockSite,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        error_codes: tuple[int, ...] = (429, 500, 502, 503, 504),
+        retry_after: int | None = None,
+        seed: int | None = None,
+    ) -> None:
+        super().__init__(address, MockRequestHandler)
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.retry_after = retry_after
+        self.random = random.Random(seed)  # noqa: S311
+        self.statuses: Counter[int] = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+
+    def error(self) -> int | None:
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.random.choice(self.error_codes)
+        return None
+
+    def count(self, status: int) -> None:
+        with self.lock:
+            self.statuses[int(status)] += 1
+
+    def report(self, interval: float) -> None:
+        served = 0
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                total = self.statuses.total()
+                statuses = dict(sorted(self.statuses.items()))
+            logging.info(
+                f'{(total - served) / interval:.1f} requests/s, {total} requests: {statuses}'
+            )
+            served = total
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    server: MockServer
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:  # noqa: N802
+        time.sleep(self.server.delay())
+        status = self.server.error()
+        body = None
+        if status is None:
+            body = self.server.site.render(urlparse(self.path).path)
+            status = HTTPStatus.OK if body is not None else HTTPStatus.NOT_FOUND
+        body = body if status == HTTPStatus.OK and body is not None else b''
+        etag = f'"{sha1(body, usedforsecurity=False).hexdigest()}"'
+        if status == HTTPStatus.OK and self.headers.get('If-None-Match') == etag:
+            status, body = HTTPStatus.NOT_MODIFIED, b''
+        self.send_response(status)
+        content_type = 'text/plain' if self.path == '/robots.txt' else 'text/html; charset=utf-8'
+        self.send_header('Content-Type', content_type)
+        if status in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        if status == HTTPStatus.TOO_MANY_REQUESTS and self.server.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+
+def recorded_pages(base_url: str) -> dict[str, bytes]:
+    """
+    Load the responses recorded in the HTTP cache, with their shamela.ws links pointing to the mock server
+    :param base_url: mock server URL
+    :return: responses bodies by path
+    """
+    settings = project.get_project_settings()
+    pages = {}
+    for spider_name in ('book', 'books', 'authors', 'categories'):
+        for response in cached_responses(settings, spider_name):
+            if response.status == HTTPStatus.OK:
+                pages[urlparse(response.url).path or '/'] = response.body.replace(
+                    SHAMELA_URL.encode(), base_url.encode()
+                )
+    return pages
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for shamela.ws')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--books', type=int, default=100, help='number of synthetic books')
+    parser.add_argument('--pages', type=int, default=50, help='pages per synthetic book')
+    parser.add_argument('--volumes', type=int, default=1, help='volumes per synthetic book')
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument(
+        '--recorded', action='store_true', help='serve the responses recorded in the HTTP cache'
+    )
+    parser.add_argument('--latency', type=float, default=0, help='response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='latency jitter in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='rate of error responses')
+    parser.add_argument(
+        '--error-codes',
+        default='429,500,502,503,504',
+        help='comma separated status codes of error responses',
+    )
+    parser.add_argument('--retry-after', type=int, help='Retry-After seconds of 429 responses')
+    parser.add_argument('--seed', type=int, help='seed of latency jitter and errors')
+    parser.add_argument(
+        '--report-interval', type=float, default=5, help='requests/s log interval in seconds'
+    )
+    args = parser.parse_args()
+    base_url = f'http://{args.host}:{args.port}'
+    site = MockSite(
+        args.books,
+        args.pages,
+        args.volumes,
+        args.categories,
+        args.authors,
+        recorded_pages(base_url) if args.recorded else None,
+    )
+    server = MockServer(
+        (args.host, args.port),
+        site,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        tuple(int(code) for code in args.error_codes.split(',')),
+        args.retry_after,
+        args.seed,
+    )
+    threading.Thread(target=server.report, args=(args.report_interval,), daemon=True).start()
+    logging.info(f'Serving a mock shamela.ws at {base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,12 @@
+# Settings profile to crawl a local mock server started with `python -m shamela.mock_server`
+#
+# SCRAPY_SETTINGS_MODULE=shamela.mock_settings scrapy crawl book -a book_id=1-100
+from shamela.settings import *  # noqa: F403
+
+SHAMELA_URL = 'http://127.0.0.1:8080'
+# Crawl at full concurrency, without the HTTP cache, and keep the crawled data apart
+DOWNLOAD_DELAY = 0
+HTTPCACHE_ENABLED = False
+DATABASE_URL = 'sqlite:///mock.db'
+PAGE_STORE_PATH = 'mock_pages.db'
+LOGSTATS_INTERVAL = 10
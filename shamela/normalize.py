@@ -0,0 +1,115 @@
+"""
+Arabic text normalization for search indexing, deduplication and hashing.
+Every character mapping is compiled into a single `str.translate` table, so text is normalized in one pass.
+"""
+
+import re
+import unicodedata
+from html import unescape
+
+# Ligatures of phrases of praise that are used in the books text
+SPECIAL_CHARACTERS = {
+    '﵀': 'رحمه الله',
+    '﵏': 'رحمهم الله',
+    '﷿': 'عز وجل',
+    '﵊': 'عليه الصلاة والسلام',
+    '﵄': 'رضي الله عنهما',
+    '﵃': 'رضي الله عنهم',
+    '﵅': 'رضي الله عنهن',
+    '﵂': 'رضي الله عنها',
+    '﵁': 'رضي الله عنه',
+    '﷾': 'سبحانه وتعالى',
+    '﵎': 'تبارك وتعالى',
+    '﵇': 'عليه السلام',
+    '﵍': 'عليها السلام',
+    '﵈': 'عليهم السلام',
+    '﵉': 'عليهما السلام',
+    '﵌': 'صلى الله عليه وآله وسلم',
+}
+SPECIAL_CHARACTERS_TABLE = str.maketrans(SPECIAL_CHARACTERS)
+
+# Tashkeel, Quranic annotation marks, superscript alef and tatweel are removed
+REMOVED_CHARACTERS = (
+    *map(chr, range(0x0610, 0x061B)),
+    *map(chr, range(0x064B, 0x0660)),
+    'ٰ',
+    *map(chr, range(0x06D6, 0x06DD)),
+    *map(chr, range(0x06DF, 0x06E9)),
+    *map(chr, range(0x06EA, 0x06EE)),
+    'ـ',
+)
+# Alef, hamza, yeh and teh marbuta variants are folded into their base letter
+FOLDED_CHARACTERS = {
+    'أ': 'ا',  # noqa: RUF001
+    'إ': 'ا',  # noqa: RUF001
+    'آ': 'ا',  # noqa: RUF001
+    'ٱ': 'ا',  # noqa: RUF001
+    'ٲ': 'ا',  # noqa: RUF001
+    'ٳ': 'ا',  # noqa: RUF001
+    'ؤ': 'و',
+    'ئ': 'ي',
+    'ى': 'ي',
+    'ی': 'ي',
+    'ة': 'ه',  # noqa: RUF001
+    'ک': 'ك',
+}
+_FOLD_TABLE = str.maketrans({**FOLDED_CHARACTERS, **dict.fromkeys(REMOVED_CHARACTERS)})
+
+
+# Normalized characters are all below this code point
+TABLE_SIZE = 0xFF00
+
+
+def _build_normalization_table() -> list[str | None]:
+    """
+    Build the translation table of all the normalization steps. Arabic presentation forms are expanded
+    into their compatibility letters, then the special characters, then folded, so the replacement of
+    each character is already fully normalized.
+    The table is a list indexed by code point, which `str.translate` looks up about twice as fast as a
+    dict. Characters past its end are kept as they are.
+    """
+    mapping: dict[str, str] = {}
+    for code_point in (*range(0xFB50, 0xFE00), *range(0xFE70, TABLE_SIZE)):
+        character = chr(code_point)
+        decomposed = unicodedata.normalize('NFKC', character)
+        if decomposed != character:
+            mapping[character] = decomposed
+    mapping.update(SPECIAL_CHARACTERS)
+    table: list[str | None] = [chr(code_point) for code_point in range(TABLE_SIZE)]
+    for character, replacement in mapping.items():
+        table[ord(character)] = replacement.translate(_FOLD_TABLE)
+    for code_point, folded in _FOLD_TABLE.items():
+        table[code_point] = folded
+    return table
+
+
+NORMALIZATION_TABLE = _build_normalization_table()
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+
+def normalize(text: str) -> str:
+    """
+    Normalize Arabic text: expand ligatures, remove diacritics and tatweel, fold letter variants
+    and collapse whitespace
+    :param text: text to normalize
+    :return: normalized text
+    """
+    return ' '.join(text.translate(NORMALIZATION_TABLE).split())
+
+
+def html_to_text(html: str) -> str:
+    """
+    Convert HTML to plain text, tags are replaced by spaces
+    :param html: HTML string
+    :return: text
+    """
+    return unescape(HTML_TAG_PATTERN.sub(' ', html))
+
+
+def search_text(html: str) -> str:
+    """
+    Convert page HTML into normalized plain text for full-text search
+    :param html: page HTML
+    :return: normalized text
+    """
+    return normalize(html_to_text(html))
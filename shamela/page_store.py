@@ -0,0 +1,188 @@
+import json
+from collections.abc import Iterator
+from hashlib import sha1
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from shamela.db import create_db_engine
+
+metadata = MetaData()
+
+books_table = Table(
+    'books',
+    metadata,
+    Column('id', Integer, primary_key=True),
+    Column('info', String),
+)
+
+pages_table = Table(
+    'pages',
+    metadata,
+    Column('book_id', Integer, primary_key=True),
+    Column('page_number', Integer, primary_key=True),
+    Column('page', Integer),
+    Column('hash', String),
+    sqlite_with_rowid=False,
+)
+
+# Page texts are stored once per content hash, so repeated pages are only stored once
+contents_table = Table(
+    'contents',
+    metadata,
+    Column('hash', String, primary_key=True),
+    Column('text', String),
+    sqlite_with_rowid=False,
+)
+
+
+def is_page_item(item: dict[str, Any]) -> bool:
+    return 'book_id' in item and 'page_number' in item
+
+
+def text_hash(text: str) -> str:
+    return sha1(text.encode(), usedforsecurity=False).hexdigest()
+
+
+def page_range(info: dict[str, Any], vol: str = '') -> tuple[int, int]:
+    """
+    Get the first and last page numbers of a book, or of its volume if only one volume was crawled
+    :param info: book info
+    :param vol: the crawled volume, or an empty string if the whole book was crawled
+    :return: tuple of start and end pages
+    """
+    start_end: tuple[int, int] = info['volumes'][vol] if vol else (1, info['all_pages'])
+    return start_end
+
+
+class PageStore:
+    """
+    On-disk content-addressed store of book pages keyed by (book_id, page_number).
+    Pages are written as soon as they are crawled, so a book is never held in memory as a whole,
+    and a book can be resumed or exported again from the stored pages.
+    """
+
+    def __init__(
+        self, path: str | Path, batch_size: int = 100, pragmas: dict[str, Any] | None = None
+    ) -> None:
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.engine = create_db_engine(f'sqlite:///{self.path}', pragmas)
+        metadata.create_all(self.engine)
+        self.connection = self.engine.connect()
+        self._pending_pages: list[dict[str, Any]] = []
+        self._pending_contents: dict[str, str] = {}
+
+    def add_page(self, book_id: int, page: dict[str, Any]) -> None:
+        page_hash = text_hash(page['text'] or '')
+        self._pending_contents[page_hash] = page['text']
+        self._pending_pages.append(
+            {
+                'book_id': book_id,
+                'page_number': page['page_number'],
+                'page': page['page'],
+                'hash': page_hash,
+            }
+        )
+        if len(self._pending_pages) >= self.batch_size:
+            self.commit()
+
+    def add_book(self, info: dict[str, Any]) -> None:
+        statement = insert(books_table).values(id=info['id'], info=json.dumps(info))
+        self.connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=['id'], set_={'info': statement.excluded.info}
+            )
+        )
+        self.commit()
+
+    def get_book(self, book_id: int) -> dict[str, Any] | None:
+        info = self.connection.execute(
+            select(books_table.c.info).where(books_table.c.id == book_id)
+        ).scalar_one_or_none()
+        if info is None:
+            return None
+        book_info: dict[str, Any] = json.loads(info)
+        # JSON object keys are strings, page chapters are keyed by page number
+        book_info['page_chapters'] = {int(k): v for k, v in book_info['page_chapters'].items()}
+        book_info['volumes'] = {k: tuple(v) for k, v in book_info['volumes'].items()}
+        return book_info
+
+    def commit(self) -> None:
+        if self._pending_contents:
+            self.connection.execute(
+                insert(contents_table).on_conflict_do_nothing(),
+                [{'hash': k, 'text': v} for k, v in self._pending_contents.items()],
+            )
+            self._pending_contents = {}
+        if self._pending_pages:
+            statement = insert(pages_table)
+            self.connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=['book_id', 'page_number'],
+                    set_={'page': statement.excluded.page, 'hash': statement.excluded.hash},
+                ),
+                self._pending_pages,
+            )
+            self._pending_pages = []
+        self.connection.commit()
+
+    def page_numbers(self, book_id: int) -> set[int]:
+        return set(
+            self.connection.scalars(
+                select(pages_table.c.page_number).where(pages_table.c.book_id == book_id)
+            )
+        )
+
+    def pages(self, book_id: int, start_end: tuple[int, int]) -> 'StoredPages':
+        self.commit()
+        return StoredPages(self, book_id, start_end)
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+        self.engine.dispose()
+
+
+class StoredPages:
+    """
+    Read-only view of the pages of one book in a PageStore between two page numbers,
+    ordered by page number.
+    """
+
+    def __init__(self, store: PageStore, book_id: int, start_end: tuple[int, int]) -> None:
+        self.store = store
+        self.book_id = book_id
+        self.start_end = start_end
+
+    def _where(self) -> Any:
+        return (pages_table.c.book_id == self.book_id) & pages_table.c.page_number.between(
+            *self.start_end
+        )
+
+    def _select(self) -> Any:
+        return (
+            select(pages_table.c.page_number, pages_table.c.page, contents_table.c.text)
+            .join(contents_table, pages_table.c.hash == contents_table.c.hash)
+            .where(self._where())
+            .order_by(pages_table.c.page_number)
+        )
+
+    def __len__(self) -> int:
+        count: int = self.store.connection.execute(
+            select(func.count()).where(self._where())
+        ).scalar_one()
+        return count
+
+    def __getitem__(self, index: int) -> dict[str, Any]:
+        offset = index + len(self) if index < 0 else index
+        row = self.store.connection.execute(self._select().limit(1).offset(offset)).first()
+        if offset < 0 or row is None:
+            raise IndexError(index)
+        return dict(row._mapping)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        for row in self.store.connection.execute(self._select()):
+            yield dict(row._mapping)
@@ -4,170 +4,496 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 # useful for handling different item types with a single interface
 import logging
-from collections.abc import Callable
-from functools import wraps
-from io import BufferedWriter
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
-from typing import Any, TypeVar, cast
+from typing import Any
 
-from scrapy import Spider
+from scrapy import Spider, signals
 from scrapy.crawler import Crawler
 from scrapy.exceptions import NotConfigured
-from scrapy.exporters import BaseItemExporter
-from sqlalchemy import create_engine
+from scrapy.settings import BaseSettings
+from scrapy.statscollectors import StatsCollector
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm import sessionmaker
+from twisted.internet import task
 
-from shamela.db import Author, Base, Book, Category
+from shamela.db import Author, Base, Book, Category, Page, engine_from_settings, sqlite_pragmas
 from shamela.exporters.epub import EpubItemExporter
-from shamela.exporters.json import SortedJsonItemExporter
+from shamela.exporters.json import BookJsonItemExporter
+from shamela.instrumentation import timed
+from shamela.normalize import search_text
+from shamela.page_store import PageStore, is_page_item, page_range
+from shamela.signals import book_exported
+from shamela.utils import content_fingerprint
 
-F = TypeVar('F', bound=Callable[..., Any])
 
-commit_threshold = 100
+def book_file(info: dict[str, Any], extension: str) -> Path:
+    """
+    Path of an exported book file, named after the book title, author and ID
+    :param info: book info
+    :param extension: file extension
+    :return: file path
+    """
+    return Path(f'{info["title"]} - {info["author"]} - ({info["id"]}).{extension}')
 
 
-def commit_session(func: F) -> F:
-    counter = 0
+class DatabasePipeline:
+    """
+    Buffer items and write them in batches with SQLite upserts.
+    Category and author IDs are resolved from in-memory maps loaded when the spider opens.
+    The buffer is flushed when it reaches DATABASE_BUFFER_SIZE rows, when its oldest row is older than
+    DATABASE_BUFFER_MAX_AGE seconds, and when the spider goes idle. When a batch fails, its rows are
+    written one at a time, so only the failing rows are lost.
+    With STORE_PAGES, the pages of crawled books are stored too, with a full-text index of their text.
+    """
 
-    @wraps(func)
-    def wrapped_func(self: 'DatabasePipeline', session: Session, *args: Any, **kwargs: Any) -> Any:
-        nonlocal counter
-        result = func(self, session, *args, **kwargs)
-        counter += 1
-        if counter >= commit_threshold:
-            try:
-                session.commit()
-            except SQLAlchemyError as err:
-                session.rollback()
-                logging.error(err)
-            finally:
-                counter = 0
-        return result
+    book_update_fields = ('title', 'author_id', 'description', 'pages', 'volumes')
+    author_update_fields = ('name', 'bio')
+    export_update_fields = ('exported_content', 'exported_at')
 
-    return cast(F, wrapped_func)
+    def __init__(
+        self,
+        settings: BaseSettings,
+        stats: StatsCollector,
+        buffer_size: int = 100,
+        max_age: float = 0,
+        store_pages: bool = False,
+    ) -> None:
+        self.settings = settings
+        self.stats = stats
+        self.buffer_size = buffer_size
+        self.max_age = max_age
+        self.store_pages = store_pages
+        self.oldest: float | None = None
+        # Books written by an export pipeline during the crawl
+        self.exported_books: set[int] = set()
+        self.flush_task = task.LoopingCall(self._flush_if_old)
 
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> 'DatabasePipeline':
+        assert crawler.stats
+        pipeline = cls(
+            crawler.settings,
+            crawler.stats,
+            crawler.settings.getint('DATABASE_BUFFER_SIZE'),
+            crawler.settings.getfloat('DATABASE_BUFFER_MAX_AGE'),
+            crawler.settings.getbool('STORE_PAGES'),
+        )
+        crawler.signals.connect(pipeline.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(pipeline.book_exported, signal=book_exported)
+        return pipeline
+
+    def book_exported(self, item: dict[str, Any]) -> None:
+        self.exported_books.add(item['info']['id'])
+
+    def spider_idle(self, spider: Spider) -> None:
+        self.flush()
 
-class DatabasePipeline:
     def open_spider(self, spider: Spider) -> None:
-        self.engine = create_engine('sqlite:///shamela.db')
+        self.engine = engine_from_settings(self.settings)
         Base.metadata.create_all(self.engine)
         self.session = sessionmaker(bind=self.engine)()
-        self.book_update_fields = ['title', 'author_id', 'description', 'pages', 'volumes']
-        self.author_update_fields = ['name', 'bio']
+        self.category_ids: dict[str, int] = dict(
+            self.session.execute(select(Category.name, Category.id)).tuples().all()
+        )
+        self.author_ids: set[int] = set(self.session.scalars(select(Author.id)))
+        # Authors are flushed before books, so books can reference them
+        self.authors: list[dict[str, Any]] = []
+        self.books: list[dict[str, Any]] = []
+        self.exports: list[dict[str, Any]] = []
+        # Pages are flushed before their volumes, so volumes are set on the new pages too
+        self.pages: list[dict[str, Any]] = []
+        self.page_volumes: list[dict[str, Any]] = []
+        if self.max_age > 0:
+            self.flush_task.start(self.max_age, now=False)
 
     def close_spider(self, spider: Spider) -> None:
-        self.session.commit()
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
         self.session.close()
         self.engine.dispose()
 
-    @commit_session
-    def _handle_book(self, session: Session, item: dict[str, str]) -> None:
-        book = session.query(Book).filter_by(id=item['id']).first()
-        if book:
-            for attr in self.book_update_fields:
-                if getattr(book, attr) != item[attr]:
-                    setattr(book, attr, item[attr])
-        else:
-            author = self.session.query(Author).filter_by(id=item['author_id']).first()
-            book = Book(
-                title=item['title'],
-                description=item['description'],
-                id=item['id'],
-                category_id=self._handle_category(session, {'name': item['category']}).id,
-                author_id=author.id if author else None,
+    @staticmethod
+    def _upsert(model: type[Base], fields: tuple[str, ...]) -> Any:
+        """
+        Build an upsert statement of model rows by ID, that only updates rows whose fields changed
+        :param model: model class
+        :param fields: fields to update
+        :return: insert statement
+        """
+        statement = insert(model)
+        table = model.__table__
+        return statement.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={
+                **{field: statement.excluded[field] for field in fields},
+                'updated_at': datetime.now(),  # noqa: DTZ005
+            },
+            where=or_(
+                *(table.c[field].is_distinct_from(statement.excluded[field]) for field in fields)
+            ),
+        )
+
+    @staticmethod
+    def _upsert_pages() -> Any:
+        """
+        Build an upsert statement of pages by book and page number, only updating changed pages
+        :return: insert statement
+        """
+        statement = insert(Page)
+        return statement.on_conflict_do_update(
+            index_elements=[Page.book_id, Page.page_number],
+            set_={f: statement.excluded[f] for f in ('page', 'text', 'search_text')},
+            where=or_(
+                Page.page.is_distinct_from(statement.excluded.page),
+                Page.text.is_distinct_from(statement.excluded.text),
+                Page.search_text.is_distinct_from(statement.excluded.search_text),
+            ),
+        )
+
+    @staticmethod
+    def _update_page_volumes() -> Any:
+        return (
+            update(Page)
+            .where(
+                Page.book_id == bindparam('page_book_id'),
+                Page.page_number.between(bindparam('start'), bindparam('end')),
+            )
+            .values(volume=bindparam('name'))
+            # Executed once per volume, instead of as an ORM bulk update by primary key
+            .execution_options(dml_strategy='core_only')
+        )
+
+    @property
+    def buffered(self) -> int:
+        return (
+            len(self.authors)
+            + len(self.books)
+            + len(self.exports)
+            + len(self.pages)
+            + len(self.page_volumes)
+        )
+
+    def _flush_if_old(self) -> None:
+        if self.oldest is not None and time.monotonic() - self.oldest >= self.max_age:
+            self.flush()
+
+    def _batches(self) -> list[tuple[Any, list[dict[str, Any]]]]:
+        """
+        Statements of the buffered rows, in the order they are written
+        :return: list of statements and their rows
+        """
+        statement = insert(Book)
+        export = statement.on_conflict_do_update(
+            index_elements=[Book.id],
+            set_={
+                **{f: statement.excluded[f] for f in self.export_update_fields},
+                'exported_listing': Book.listing_fingerprint,
+            },
+        )
+        return [
+            (self._upsert(Author, self.author_update_fields), self.authors),
+            (self._upsert(Book, self.book_update_fields), self.books),
+            (export, self.exports),
+            (self._upsert_pages(), self.pages),
+            (self._update_page_volumes(), self.page_volumes),
+        ]
+
+    @timed
+    def flush(self) -> None:
+        rows = self.buffered
+        batches = [(statement, batch) for statement, batch in self._batches() if batch]
+        self.authors, self.books, self.exports = [], [], []
+        self.pages, self.page_volumes = [], []
+        self.oldest = None
+        if not batches:
+            return
+        try:
+            for statement, batch in batches:
+                self.session.execute(statement, batch)
+            self.session.commit()
+            self.stats.inc_value('database/flushes')
+            self.stats.inc_value('database/rows', rows)
+        except SQLAlchemyError as err:
+            self.session.rollback()
+            logging.error(f'Failed to write {rows} rows, writing them one at a time: {err}')
+            self._write_rows(batches)
+
+    def _write_rows(self, batches: list[tuple[Any, list[dict[str, Any]]]]) -> None:
+        """
+        Write the rows of a failed flush one at a time, so only the failing rows are lost
+        :param batches: statements and their rows
+        :return:
+        """
+        for statement, batch in batches:
+            for row in batch:
+                try:
+                    self.session.execute(statement, [row])
+                    self.session.commit()
+                    self.stats.inc_value('database/rows')
+                except SQLAlchemyError as err:
+                    self.session.rollback()
+                    self.stats.inc_value('database/errors')
+                    logging.error(err)
+
+    def _buffer(self, rows: list[dict[str, Any]], row: dict[str, Any]) -> None:
+        rows.append(row)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        elif self.max_age > 0:
+            self._flush_if_old()
+
+    def _handle_book(self, item: dict[str, Any]) -> None:
+        self._buffer(
+            self.books,
+            {
+                'id': item['id'],
+                'title': item['title'],
+                'description': item['description'],
+                'pages': item['pages'],
+                'volumes': item['volumes'],
+                'category_id': self._category_id(item['category']),
+                'author_id': item['author_id'] if item['author_id'] in self.author_ids else None,
+            },
+        )
+
+    def _category_id(self, name: str) -> int:
+        if name not in self.category_ids:
+            statement = insert(Category).values(name=name)
+            category_id: int = self.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[Category.name], set_={'name': statement.excluded.name}
+                ).returning(Category.id)
+            ).scalar_one()
+            # Committed right away, so a failed flush can't roll back a cached category
+            self.session.commit()
+            self.category_ids[name] = category_id
+        return self.category_ids[name]
+
+    def _handle_author(self, author_item: dict[str, Any]) -> None:
+        self.author_ids.add(author_item['id'])
+        self._buffer(
+            self.authors,
+            {'id': author_item['id'], **{f: author_item[f] for f in self.author_update_fields}},
+        )
+
+    def _handle_book_export(self, item: dict[str, Any]) -> None:
+        info = item['info']
+        self._buffer(
+            self.exports,
+            {
+                'id': info['id'],
+                'title': info['title'],
+                # Books that are not in the database yet have no listing
+                'exported_listing': 'None:None',
+                'exported_content': content_fingerprint(
+                    info['all_pages'], item['pages'][0]['text'] if len(item['pages']) else ''
+                ),
+                'exported_at': datetime.now(),  # noqa: DTZ005
+            },
+        )
+
+    def _handle_page(self, book_id: int, page: dict[str, Any]) -> None:
+        self._buffer(
+            self.pages,
+            {
+                'book_id': book_id,
+                'page_number': page['page_number'],
+                'page': page['page'],
+                'text': page['text'],
+                'search_text': search_text(page['text'] or ''),
+            },
+        )
+
+    def _handle_book_pages(self, item: dict[str, Any]) -> None:
+        info = item['info']
+        if isinstance(item.get('pages'), list):
+            for page in item['pages']:
+                self._handle_page(info['id'], page)
+        elif 'pages' in item:
+            # Streamed pages were already handled as separate items, but the pages stored by an
+            # earlier run are only in the page store
+            indexed = self._indexed_pages(info['id'])
+            for page in item['pages']:
+                if page['page_number'] not in indexed:
+                    self._handle_page(info['id'], page)
+        for name, (start, end) in info['volumes'].items():
+            self._buffer(
+                self.page_volumes,
+                {'page_book_id': info['id'], 'start': start, 'end': end, 'name': name},
             )
-            session.add(book)
-
-    @commit_session
-    def _handle_category(self, session: Session, category_item: dict[str, str]) -> Category:
-        category = session.query(Category).filter_by(name=category_item['name']).first()
-        if not category:
-            category = Category(name=category_item['name'])
-            session.add(category)
-        return category
-
-    @commit_session
-    def _handle_author(self, session: Session, author_item: dict[str, str]) -> Author | None:
-        author = session.query(Author).filter_by(id=author_item['id']).first()
-        if author:
-            for attr in self.author_update_fields:
-                if getattr(author, attr) != author_item[attr]:
-                    setattr(author, attr, author_item[attr])
-        else:
-            author = Author(**author_item)
-            session.add(author)
-        return author
-
-    def process_item(self, item: dict[str, str], spider: Spider) -> dict[str, str]:
+
+    def _indexed_pages(self, book_id: int) -> set[int]:
+        """
+        Get the page numbers of a book that are in the database or buffered to be written
+        :param book_id: book ID
+        :return: set of page numbers
+        """
+        indexed: set[int] = set(
+            self.session.scalars(select(Page.page_number).where(Page.book_id == book_id))
+        )
+        indexed.update(page['page_number'] for page in self.pages if page['book_id'] == book_id)
+        return indexed
+
+    @timed
+    def process_item(self, item: dict[str, Any], spider: Spider) -> dict[str, Any]:
+        if spider.name == 'book' and self.store_pages:
+            if is_page_item(item):
+                self._handle_page(item['book_id'], item)
+            elif 'info' in item:
+                self._handle_book_pages(item)
+        # The export is only recorded for whole books, once all the enabled exporters wrote them
+        if (
+            spider.name == 'book'
+            and 'info' in item
+            and 'pages' in item
+            and item['info']['id'] in self.exported_books
+            and not getattr(spider, 'vol', '')
+        ):
+            self._handle_book_export(item)
         if spider.name == 'categories':
-            self._handle_category(self.session, item)
+            self._category_id(item['name'])
         if spider.name == 'authors':
-            self._handle_author(self.session, item)
+            self._handle_author(item)
         if spider.name == 'books':
-            self._handle_book(self.session, item)
+            self._handle_book(item)
         return item
 
 
-class BookJSONExportPipeline:
-    def __init__(self) -> None:
-        self.exporter: BaseItemExporter | None = None
-        self.file: BufferedWriter | None = None
+class PageStorePipeline:
+    def __init__(
+        self, path: str, resume: bool = False, pragmas: dict[str, Any] | None = None
+    ) -> None:
+        self.path = Path(path)
+        self.pragmas = pragmas
+        # The store is kept between runs when resuming, otherwise it only lives during the crawl
+        self.resume = resume
+        self.store: PageStore | None = None
 
     @classmethod
-    def from_crawler(cls, crawler: Crawler) -> 'BookJSONExportPipeline':
-        if not crawler.settings.getbool('MAKE_JSON'):
+    def from_crawler(cls, crawler: Crawler) -> 'PageStorePipeline':
+        resume = crawler.settings.getbool('RESUME_PAGES')
+        if not crawler.settings.getbool('STREAM_PAGES') and not resume:
             raise NotConfigured
-        return cls()
+        return cls(
+            crawler.settings.get('PAGE_STORE_PATH'), resume, sqlite_pragmas(crawler.settings)
+        )
+
+    def open_spider(self, spider: Spider) -> None:
+        if not self.resume:
+            self.path.unlink(missing_ok=True)
+        self.store = PageStore(self.path, pragmas=self.pragmas)
 
     def close_spider(self, spider: Spider) -> None:
-        if self.exporter:
-            self.exporter.finish_exporting()
-        if self.file:
-            self.file.close()
+        if self.store:
+            self.store.close()
+        if not self.resume:
+            self.path.unlink(missing_ok=True)
 
+    @timed
     def process_item(self, item: dict[str, Any], spider: Spider) -> dict[str, Any]:
-        if spider.name != 'book' or 'info' not in item or self.file:
+        if spider.name != 'book' or not self.store:
             return item
+        if is_page_item(item):
+            self.store.add_page(item['book_id'], item)
+        elif 'info' in item and 'pages' not in item:
+            # Book pages are read back from the store by the exporters, one page at a time
+            item['pages'] = self.store.pages(
+                item['info']['id'], page_range(item['info'], getattr(spider, 'vol', ''))
+            )
+            item['info']['pages'] = len(item['pages'])
+            self.store.add_book(item['info'])
+        return item
+
+
+class BookJSONExportPipeline:
+    def __init__(self, compact: bool = False) -> None:
+        self.compact = compact
+        self.exported: set[int] = set()
 
-        file = Path(f'{item["info"]["title"]}.json')
-        if file.exists():
-            file.unlink(missing_ok=True)
-        self.file = file.open('wb')
-        self.exporter = SortedJsonItemExporter(self.file)
-        self.exporter.export_item(item)
+    @classmethod
+    def from_crawler(cls, crawler: Crawler) -> 'BookJSONExportPipeline':
+        if not crawler.settings.getbool('MAKE_JSON'):
+            raise NotConfigured
+        return cls(crawler.settings.getbool('JSON_COMPACT'))
+
+    @timed
+    def process_item(self, item: dict[str, Any], spider: Spider) -> dict[str, Any]:
+        if spider.name != 'book' or 'info' not in item or item['info']['id'] in self.exported:
+            return item
+        self.export_book(item)
+        spider.crawler.signals.send_catch_log(book_exported, item=item)
         return item
 
+    @timed
+    def export_book(self, item: dict[str, Any]) -> None:
+        self.exported.add(item['info']['id'])
+        with book_file(item['info'], 'json').open('wb') as file:
+            exporter = BookJsonItemExporter(file, compact=self.compact)
+            exporter.start_exporting()
+            exporter.export_item(item)
+            exporter.finish_exporting()
+
 
 class BookEPUBExportPipeline:
-    def __init__(self, update_hamesh: bool = False) -> None:
+    def __init__(
+        self, update_hamesh: bool = False, stream: bool = False, processes: int = 0
+    ) -> None:
         self.update_hamesh = update_hamesh
-        self.exporter: BaseItemExporter | None = None
-        self.file: BufferedWriter | None = None
+        self.stream = stream
+        # Workers are started with spawn, as the crawler process runs threads that fork doesn't copy
+        self.executor = (
+            ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+            if processes > 1
+            else None
+        )
+        self.exported: set[int] = set()
 
     @classmethod
     def from_crawler(cls, crawler: Crawler) -> 'BookEPUBExportPipeline':
         if not crawler.settings.getbool('MAKE_EPUB'):
             raise NotConfigured
-        return cls(crawler.settings.getbool('UPDATE_EPUB_HAMESH'))
+        return cls(
+            crawler.settings.getbool('UPDATE_EPUB_HAMESH'),
+            crawler.settings.getbool('STREAM_EPUB'),
+            crawler.settings.getint('EPUB_PROCESSES'),
+        )
 
     def close_spider(self, spider: Spider) -> None:
-        if self.exporter:
-            self.exporter.finish_exporting()
-        if self.file:
-            self.file.close()
+        self.close()
 
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    @timed
     def process_item(self, item: dict[str, Any], spider: Spider) -> dict[str, Any]:
-        if spider.name != 'book' or 'info' not in item or 'pages' not in item or self.file:
+        if (
+            spider.name != 'book'
+            or 'info' not in item
+            or 'pages' not in item
+            or item['info']['id'] in self.exported
+        ):
             return item
-
-        file = Path(
-            f'{item["info"]["title"]} - {item["info"]["author"]} - ({item["info"]["id"]}).epub'
-        )
-        if file.exists():
-            file.unlink(missing_ok=True)
-        self.file = file.open('wb')
-        self.exporter = EpubItemExporter(self.file, update_hamesh=self.update_hamesh)
-        self.exporter.start_exporting()
-        self.exporter.export_item(item)
+        self.export_book(item)
+        spider.crawler.signals.send_catch_log(book_exported, item=item)
         return item
+
+    @timed
+    def export_book(self, item: dict[str, Any]) -> None:
+        self.exported.add(item['info']['id'])
+        with book_file(item['info'], 'epub').open('wb') as file:
+            exporter = EpubItemExporter(
+                file, update_hamesh=self.update_hamesh, stream=self.stream, executor=self.executor
+            )
+            exporter.start_exporting()
+            exporter.export_item(item)
+            exporter.finish_exporting()
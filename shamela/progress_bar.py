@@ -1,61 +1,130 @@
-from scrapy import Item, Request, Spider, signals
+from dataclasses import dataclass
+from typing import Any
+
+from scrapy import Request, Spider, signals
 from scrapy.crawler import Crawler
 from scrapy.http import Response
 from scrapy.statscollectors import StatsCollector
 from tqdm import tqdm
 
+from shamela.page_store import is_page_item
+from shamela.signals import book_started
 from shamela.utils import get_number_from_url
 
 
+@dataclass
+class BookProgress:
+    bar: tqdm
+    start: int
+    end: int
+
+
 class ProgressBarExtension:
+    """
+    Show the progress of the crawl in pages, with the pages/s rate, the cache hit rate and the ETA.
+    For the book spider, the pages count of each book (or of its crawled volume) is known from its
+    first page, so each book has its own bar with an exact total, and the overall total is the
+    pages of the started books plus an estimate for the books that are not started yet.
+    Retried requests and pages out of the crawled range are not counted as progress.
+    """
+
     def __init__(self, stats: StatsCollector) -> None:
         self.stats = stats
         self.items_scraped = 0
         self.items_dropped = 0
-        self.pages_crawled = 0
-        self.progress_bar = None
+        self.responses = 0
+        self.cache_hits = 0
+        self.progress_bar: tqdm | None = None
+        self.books: dict[int, BookProgress] = {}
+        self.books_total = 0
+        self.books_started = 0
+        self.books_finished = 0
+        self.started_pages = 0
 
     @classmethod
     def from_crawler(cls, crawler: Crawler) -> 'ProgressBarExtension':
+        assert crawler.stats
         ext = cls(crawler.stats)
         crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
         crawler.signals.connect(ext.item_dropped, signal=signals.item_dropped)
         crawler.signals.connect(ext.page_crawled, signal=signals.response_received)
+        crawler.signals.connect(ext.book_started, signal=book_started)
         crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
         return ext
 
-    def item_scraped(self, item: Item, response: Response, spider: Spider) -> None:
+    def _overall(self) -> tqdm:
+        if self.progress_bar is None:
+            self.progress_bar = tqdm(unit='page', dynamic_ncols=True)
+        return self.progress_bar
+
+    def item_scraped(self, item: Any, response: Response, spider: Spider) -> None:
         self.items_scraped += 1
-        self.update_progress_bar()
+        self._book_done(item, spider)
 
     def item_dropped(
-        self, item: Item, response: Response, exception: Exception, spider: Spider
+        self, item: Any, response: Response, exception: Exception, spider: Spider
     ) -> None:
         self.items_dropped += 1
-        self.update_progress_bar()
+        self._book_done(item, spider)
+
+    def book_started(  # noqa: PLR0913
+        self, book_id: int, title: str, start: int, end: int, done: int, spider: Spider
+    ) -> None:
+        overall = self._overall()
+        total = end - start + 1
+        self.books[book_id] = BookProgress(
+            tqdm(
+                total=total, initial=done, desc=f'{book_id} {title}'[:40], unit='page', leave=False
+            ),
+            start,
+            end,
+        )
+        self.books_total = len(getattr(spider, 'book_ids', None) or ())
+        self.books_started += 1
+        self.started_pages += total
+        overall.total = self._estimated_total()
+        overall.update(done)
 
     def page_crawled(self, response: Response, request: Request, spider: Spider) -> None:
-        if self.progress_bar is None:
-            self.progress_bar = tqdm(total=self.stats.get_value('downloader/response_count'))
-        self.pages_crawled += 1
-        # Update the total number of pages in the progress bar after the first page is crawled in book spider
-        if (
-            self.progress_bar
-            and self.progress_bar.total == 1
-            and spider.name == 'book'
-            and 'data' in response.meta
-            and get_number_from_url(response.url) > 1
+        overall = self._overall()
+        self.responses += 1
+        if 'cached' in response.flags:
+            self.cache_hits += 1
+        if spider.name != 'book':
+            overall.update()
+        elif (
+            (data := request.meta.get('data'))
+            and (book := self.books.get(data['info']['id']))
+            and book.start <= get_number_from_url(response.url) <= book.end
         ):
-            self.progress_bar.total = response.meta['data']['info']['all_pages']
-        self.update_progress_bar()
+            book.bar.update()
+            overall.update()
+        self._update_description()
 
-    def update_progress_bar(self) -> None:
-        if self.progress_bar is not None:
-            self.progress_bar.set_description(
-                f'Pages: {self.pages_crawled} Items: {self.items_scraped} Dropped: {self.items_dropped}'
-            )
-            self.progress_bar.update()
+    def _book_done(self, item: Any, spider: Spider) -> None:
+        if spider.name == 'book' and 'info' in item and not is_page_item(item):
+            self.books_finished += 1
+            if book := self.books.pop(item['info']['id'], None):
+                book.bar.close()
+        self._update_description()
+
+    def _estimated_total(self) -> int:
+        skipped = int(self.stats.get_value('book/skipped_unchanged', 0))
+        pending_books = max(self.books_total - self.books_started - skipped, 0)
+        return self.started_pages + round(self.started_pages / self.books_started * pending_books)
+
+    def _update_description(self) -> None:
+        if self.progress_bar is None:
+            return
+        description = f'Items: {self.items_scraped} Dropped: {self.items_dropped}'
+        if self.books_started:
+            description = f'Books: {self.books_finished}/{self.books_total} {description}'
+        cache = self.cache_hits / self.responses if self.responses else 0
+        self.progress_bar.set_description_str(description, refresh=False)
+        self.progress_bar.set_postfix_str(f'cache {cache:.0%}', refresh=False)
 
     def spider_closed(self, spider: Spider, reason: str) -> None:
+        for book in self.books.values():
+            book.bar.close()
         if self.progress_bar is not None:
             self.progress_bar.close()
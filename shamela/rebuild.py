@@ -0,0 +1,54 @@
+import argparse
+import logging
+
+from scrapy.utils import project
+
+from shamela.page_store import PageStore, page_range
+from shamela.pipelines import BookEPUBExportPipeline, BookJSONExportPipeline
+from shamela.utils import parse_ids
+
+
+def rebuild(book_ids: list[int], make_json: bool, make_epub: bool) -> None:
+    """
+    Export books from the page store without crawling them again
+    :param book_ids: IDs of the books to export
+    :param make_json: export the books as JSON
+    :param make_epub: export the books as EPUB
+    :return:
+    """
+    settings = project.get_project_settings()
+    store = PageStore(settings.get('PAGE_STORE_PATH'))
+    json_pipeline = BookJSONExportPipeline(settings.getbool('JSON_COMPACT'))
+    epub_pipeline = BookEPUBExportPipeline(
+        settings.getbool('UPDATE_EPUB_HAMESH'),
+        settings.getbool('STREAM_EPUB'),
+        settings.getint('EPUB_PROCESSES'),
+    )
+    try:
+        for book_id in book_ids:
+            info = store.get_book(book_id)
+            if info is None:
+                logging.error(f'Book {book_id} is not in the page store')
+                continue
+            item = {'info': info, 'pages': store.pages(book_id, page_range(info))}
+            if make_json:
+                json_pipeline.export_book(item)
+            if make_epub:
+                epub_pipeline.export_book(item)
+    finally:
+        epub_pipeline.close()
+        store.close()
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description='Export books from the page store')
+    parser.add_argument('book_ids', help='book IDs, e.g. 1,5,10-20')
+    parser.add_argument('--json', action='store_true', help='export the books as JSON')
+    parser.add_argument('--epub', action='store_true', help='export the books as EPUB')
+    args = parser.parse_args()
+    rebuild(parse_ids(args.book_ids), args.json, args.epub)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
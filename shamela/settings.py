@@ -8,6 +8,8 @@
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 BOT_NAME = 'shamela'
+# Site to crawl, such as a local mock server (see shamela/mock_settings.py)
+SHAMELA_URL = 'https://shamela.ws'
 
 SPIDER_MODULES = ['shamela.spiders']
 NEWSPIDER_MODULE = 'shamela.spiders'
@@ -24,6 +26,7 @@ CONCURRENT_REQUESTS = 64
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
+# Also the minimum delay of AdaptiveConcurrencyMiddleware, which slows down when the site is overloaded
 DOWNLOAD_DELAY = 0.25
 # The download delay setting will honor only one of:
 CONCURRENT_REQUESTS_PER_DOMAIN = 64
@@ -43,15 +46,20 @@ COOKIES_ENABLED = False
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    "shamela.middlewares.ShamelaSpiderMiddleware": 543,
-# }
+SPIDER_MIDDLEWARES = {
+    # Closest to the spider, to time the callbacks
+    'shamela.instrumentation.InstrumentationMiddleware': 1000,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "shamela.middlewares.ShamelaDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'shamela.httpcache.RevalidatingCacheMiddleware': 900,
+    # Only with ADAPTIVE_CONCURRENCY_ENABLED. Closest to the downloader, to see the responses before they
+    # are retried or replaced from the cache
+    'shamela.middlewares.AdaptiveConcurrencyMiddleware': 950,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -62,13 +70,40 @@ COOKIES_ENABLED = False
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    'shamela.pipelines.DatabasePipeline': 300,
+    'shamela.pipelines.PageStorePipeline': 200,
     'shamela.pipelines.BookEPUBExportPipeline': 301,
     'shamela.pipelines.BookJSONExportPipeline': 302,
+    # After the exporters, so a book is only recorded as exported once its files are written
+    'shamela.pipelines.DatabasePipeline': 400,
+}
+DATABASE_URL = 'sqlite:///shamela.db'
+# Faster SQLite writes: WAL journal lets readers query the database while the crawl writes to it
+SQLITE_PERFORMANCE_PROFILE = False
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,  # 64 MiB
+    'mmap_size': 256 * 1024 * 1024,  # 256 MiB
+    'temp_store': 'MEMORY',
 }
+# Rows buffered by DatabasePipeline before they are written, and the maximum age in seconds of a buffered row
+DATABASE_BUFFER_SIZE = 100
+DATABASE_BUFFER_MAX_AGE = 5
 MAKE_JSON = False
+# Book JSON without whitespace, serialized with orjson when it is installed
+JSON_COMPACT = False
 MAKE_EPUB = False
 UPDATE_EPUB_HAMESH = False
+# Write each EPUB page to the file as soon as it is rendered, instead of keeping the whole book in memory
+STREAM_EPUB = False
+# Processes that render the EPUB pages, 0 or 1 renders them in the crawler process
+EPUB_PROCESSES = 0
+PARALLEL_PAGES = False
+STREAM_PAGES = False
+PAGE_STORE_PATH = 'pages.db'
+RESUME_PAGES = False
+INCREMENTAL = False
+STORE_PAGES = False
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -89,7 +124,14 @@ HTTPCACHE_ENABLED = True
 HTTPCACHE_EXPIRATION_SECS = 7 * 24 * 60 * 60  # 1 week
 HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_HTTP_CODES: list[int] = []
+# Revalidate expired responses with the server instead of downloading them again, needs SqliteCacheStorage
+HTTPCACHE_POLICY = 'shamela.httpcache.RevalidatingPolicy'
+# Set to 'shamela.httpcache.SqliteCacheStorage' for a single SQLite file per spider, see shamela/httpcache.py
 HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Compression of SqliteCacheStorage bodies, zstd needs the zstandard package
+HTTPCACHE_COMPRESSION = 'zlib'
+HTTPCACHE_COMPRESSION_LEVEL = 3
+# Used by FilesystemCacheStorage, and to import its responses with `python -m shamela.httpcache import`
 HTTPCACHE_GZIP = True
 
 TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
@@ -100,6 +142,14 @@ RETRY_ENABLED = True
 RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429, 525]
 RETRY_TIMES = 10
 
+# Adaptive concurrency, the RETRY_HTTP_CODES statuses are congestion signals
+ADAPTIVE_CONCURRENCY_ENABLED = False
+ADAPTIVE_CONCURRENCY_START = 8
+ADAPTIVE_CONCURRENCY_MAX = CONCURRENT_REQUESTS_PER_DOMAIN
+ADAPTIVE_CONCURRENCY_BACKOFF = 0.5
+ADAPTIVE_CONCURRENCY_LATENCY_FACTOR = 3
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 60
+
 # HTTP/2
 DOWNLOAD_HANDLERS = {
     'https': 'scrapy.core.downloader.handlers.http2.H2DownloadHandler',
@@ -108,7 +158,13 @@ DOWNLOAD_HANDLERS = {
 # Custom
 EXTENSIONS = {
     'shamela.progress_bar.ProgressBarExtension': 500,
+    'shamela.instrumentation.Instrumentation': 510,
 }
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_INTERVAL = 10
+INSTRUMENTATION_FORMAT = 'jsonl'
+INSTRUMENTATION_PATH = 'instrumentation.jsonl'
+INSTRUMENTATION_PORT = 0
 FEED_EXPORTERS = {
     'json': 'shamela.exporters.json.SortedJsonItemExporter',
 }
@@ -0,0 +1,11 @@
+"""
+Custom signals, see https://docs.scrapy.org/en/latest/topics/signals.html
+"""
+
+# Sent by the book spider once the pages of a book are known from its first page, with the arguments:
+# book_id, title, start and end (the crawled pages range) and done (the pages of the range already
+# downloaded or stored)
+book_started = object()
+# Sent by the export pipelines once the whole item of a book is written to a file, with the arguments:
+# item
+book_exported = object()
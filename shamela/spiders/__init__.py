@@ -2,3 +2,27 @@
 #
 # Please refer to the documentation for information on how to create and manage
 # your spiders.
+from typing import Any, ClassVar, Self
+from urllib.parse import urlparse
+
+from scrapy.crawler import Crawler
+
+SHAMELA_URL = 'https://shamela.ws'
+
+
+class SiteMixin:
+    """
+    Crawl the site at the SHAMELA_URL setting, such as a local mock server, instead of shamela.ws
+    """
+
+    site_url: str = SHAMELA_URL
+    start_path: ClassVar[str | None] = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler, *args: Any, **kwargs: Any) -> Self:
+        spider = super().from_crawler(crawler, *args, **kwargs)  # type: ignore[misc]
+        spider.site_url = crawler.settings.get('SHAMELA_URL', SHAMELA_URL).rstrip('/')
+        spider.allowed_domains = [urlparse(spider.site_url).hostname]
+        if cls.start_path is not None:
+            spider.start_urls = [f'{spider.site_url}{cls.start_path}']
+        return spider  # type: ignore[no-any-return]
@@ -5,13 +5,14 @@ from scrapy.http import Response
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 
+from shamela.spiders import SiteMixin
 from shamela.utils import get_number_from_url
 
 
-class Authors(CrawlSpider):
+class Authors(SiteMixin, CrawlSpider):
     name = 'authors'
     allowed_domains: ClassVar[list[str]] = ['shamela.ws']
-    start_urls: ClassVar[list[str]] = ['https://shamela.ws/authors']
+    start_path = '/authors'
 
     rules = (Rule(LinkExtractor(allow=r'author/'), callback='parse_item', follow=False),)
 
@@ -1,17 +1,27 @@
 import re
-from collections.abc import Generator
+from collections.abc import AsyncIterator, Generator
 from enum import Enum
 from re import Pattern
 from typing import Any, ClassVar
 
+from lxml.etree import XPath
 from scrapy import Request, Selector
 from scrapy.http import Response
 from scrapy.selector import SelectorList
 from scrapy.spiders import Spider
+from scrapy.statscollectors import StatsCollector
+from twisted.python.failure import Failure
 
-from shamela.utils import get_number_from_url
+from shamela.db import engine_from_settings, get_book_ids, get_books, sqlite_pragmas
+from shamela.instrumentation import timed
+from shamela.page_store import PageStore, page_range
+from shamela.signals import book_started
+from shamela.spiders import SiteMixin
+from shamela.utils import content_fingerprint, get_number_from_url, parse_ids
 
 TocType = list[dict[str, Any] | list[dict[str, Any]]]
+# Pages of books that are already being crawled are scheduled before new books are started
+PAGE_PRIORITY = 1
 
 
 class Selectors(Enum):
@@ -31,20 +41,59 @@ class Selectors(Enum):
     LAST_PAGE = f'{PAGE_NUMBER} + a + a'
 
 
-class Book(Spider):
+class Book(SiteMixin, Spider):
     name = 'book'
     allowed_domains: ClassVar[list[str]] = ['shamela.ws']
 
     PARENT_DIV_CLASS_PATTERN: Pattern = re.compile(r' class="nass margin-top-10"')
-    HTML_STYLE_PATTERN: Pattern = re.compile(r' style="(.*?)"')
+    HAS_TEXT = XPath('boolean(.//text())')
 
-    def __init__(self, book_id: int, vol: str = '', *args: Any, **kwargs: Any) -> None:
+    def __init__(self, book_id: int | str, vol: str = '', *args: Any, **kwargs: Any) -> None:
+        """
+        :param book_id: a book ID, a list and/or range of IDs such as `1,5,10-20`,
+         or `all` to crawl all the books in the database
+        :param vol: the volume to crawl, only when crawling a single book
+        """
         super().__init__(*args, **kwargs)
-        self.book_id = book_id
-        self.start_urls = [f'https://shamela.ws/book/{book_id}']
+        # All the books IDs are read from the database when the crawl starts
+        self.book_ids: list[int] | None = None if str(book_id) == 'all' else parse_ids(str(book_id))
+        if vol and (self.book_ids is None or len(self.book_ids) > 1):
+            raise ValueError('Volume can only be set when crawling a single book')
         self.vol = vol
+        self.exported_content: dict[int, str] = {}
+        self.page_store: PageStore | None = None
+
+    async def start(self) -> AsyncIterator[Any]:
+        incremental = self.settings.getbool('INCREMENTAL') and not self.vol
+        books = {}
+        if incremental or self.book_ids is None:
+            engine = engine_from_settings(self.settings)
+            if self.book_ids is None:
+                self.book_ids = get_book_ids(engine)
+            if incremental:
+                books = get_books(engine)
+            engine.dispose()
+        for book_id in self.book_ids:
+            book = books.get(book_id)
+            if book and book.is_listing_unchanged:
+                self.logger.info(f'Skipping book {book_id}, its listing is unchanged')
+                self.stats.inc_value('book/skipped_unchanged')
+                continue
+            if book and book.exported_content:
+                self.exported_content[book_id] = str(book.exported_content)
+            yield Request(f'{self.site_url}/book/{book_id}', dont_filter=True)
 
-    def parse(self, response: Response, **kwargs: Any) -> Generator[dict[str, str | int]]:
+    @property
+    def stats(self) -> StatsCollector:
+        assert self.crawler.stats
+        return self.crawler.stats
+
+    def closed(self, reason: str) -> None:
+        if self.page_store:
+            self.page_store.close()
+
+    def parse(self, response: Response, **kwargs: Any) -> Generator[Request]:
+        book_id = get_number_from_url(response.url)
         html = response.css(Selectors.PAGE_CONTENT.value)
         html.css(Selectors.SEARCH.value).drop()  # Remove "Search" button
         toc_el = html.css(Selectors.INDEX.value)
@@ -59,17 +108,17 @@ class Book(Spider):
                 'author': response.css(Selectors.AUTHOR.value).get(),
                 'about': self.PARENT_DIV_CLASS_PATTERN.sub('', html.get()),
                 'url': response.url,
-                'id': self.book_id,
+                'id': book_id,
                 'toc': toc,
                 'page_chapters': page_chapters,
             }
         }
-        book_text_url = f'https://shamela.ws/book/{self.book_id}/1'
-        yield response.follow(book_text_url, self.parse_book_text, meta={'data': data})
+        book_text_url = f'{self.site_url}/book/{book_id}/1'
+        yield response.follow(
+            book_text_url, self.parse_book_text, meta={'data': data}, priority=PAGE_PRIORITY
+        )
 
-    def parse_book_text(  # noqa: C901, PLR0912
-        self, response: Response, **kwargs: Any
-    ) -> Generator[dict[str, str | int]]:
+    def parse_book_text(self, response: Response, **kwargs: Any) -> Generator[Any]:
         """
         Parse the book text pages
         :param response:
@@ -77,77 +126,282 @@ class Book(Spider):
         :return:
         """
         page_number = get_number_from_url(response.url)
-        page = int(response.css(f'{Selectors.PAGE_NUMBER.value}::attr(value)').get('0'))
         data = response.meta['data']
-        if 'pages' not in data:
+        stored: set[int] = response.meta.get('stored', set())
+        if 'pages' not in data and not self._streams_pages():
             data['pages'] = []
 
         if page_number == 1:
-            data['info']['all_pages'] = int(
-                response.css(f'{Selectors.LAST_PAGE.value}::attr(href)').re_first(r'(\d+)#')
-            )
-            data['info']['volumes'] = {}
-            if parts := response.css(Selectors.PAGE_PARTS_MENU.value):
-                volumes = {}
-                for part in parts.css('li a')[1:]:
-                    volumes[part.css('::text').get()] = int(
-                        part.css('::attr(href)').re_first(r'(\d+)#')
-                    )
-                data['info']['volumes'] = self._get_start_end_pages(
-                    volumes, data['info']['all_pages']
-                )
-            # Check if the required volume is valid
-            if self.vol and not response.css(f'{Selectors.PAGE_PARTS_MENU.value} li a::text')[
-                1:
-            ].re(self.vol):
-                raise ValueError(f'Volume {self.vol} not found in book {self.book_id}')
+            self._parse_book_volumes(response, data)
+            if self._is_content_unchanged(response, data):
+                return
+            stored = self._stored_pages(data['info']['id'])
+            self._book_started(data, stored)
+            if self.settings.getbool('PARALLEL_PAGES'):
+                yield from self._fan_out_pages(response, data, stored)
+                return
             # if current page is not the required volume, jump to required volume's first page
             if self.vol and self.vol != response.css(Selectors.PAGE_PART.value).get().strip():
-                yield Request(
-                    url=f'https://shamela.ws/book/{self.book_id}/{data["info"]["volumes"][self.vol][0]}',
-                    callback=self.parse_book_text,
-                    meta={'data': data},
+                yield from self._follow_missing_page(
+                    data, stored, data['info']['volumes'][self.vol][0] - 1
                 )
                 return
         # Check if the current page is the last page of the volume
         if self.vol and page_number > data['info']['volumes'][self.vol][1]:
-            data = self._update_data_for_one_volume(data, data['info']['volumes'][self.vol])
-            data['info']['pages'] = len(data['pages'])
-            yield data
+            yield self._finish_book(data)
             return
 
-        html = response.css(Selectors.PAGE_CONTENT.value)
-        html.css(Selectors.COPY_BTN.value).drop()  # Remove "Copy" button
-        html = Selector(text=self.PARENT_DIV_CLASS_PATTERN.sub('', html.get()))
-        # Delete empty spans
-        for element in html.css('span'):
-            if not element.css('::text').get():
-                element.drop()
-        # Delete paragraph style
-        for _ in html.css('p[style="font-size: 15px"]'):
-            _ = Selector(text=self.HTML_STYLE_PATTERN.sub('', html.get()))
-
-        data['pages'].append(
-            {
-                'page_number': page_number,
-                'page': page,
-                'text': html.css('div').get(),
-                # 'html': response.css('.padding-top-20 .container').get()
-            }
-        )
+        if page_number not in stored:
+            yield from self._add_page(data, self._parse_page(response, page_number))
 
         # Follow pagination links and parse those pages
         if not response.css(Selectors.LAST_PAGE.value):
-            if self.vol and page_number == data['info']['volumes'][self.vol][1]:
-                data = self._update_data_for_one_volume(data, data['info']['volumes'][self.vol])
-            data['info']['pages'] = len(data['pages'])
-            yield data
+            yield self._finish_book(data)
+        elif page_number + 1 in stored:
+            yield from self._follow_missing_page(data, stored, page_number)
         else:
             yield response.follow(
                 response.css(Selectors.NEXT_PAGE.value).attrib.get('href'),
                 self.parse_book_text,
-                meta={'data': data},
+                meta={'data': data, 'stored': stored},
+                priority=PAGE_PRIORITY,
+            )
+
+    def parse_book_page(self, response: Response, **kwargs: Any) -> Generator[dict[str, Any]]:
+        """
+        Parse a single book text page requested by the parallel mode
+        :param response:
+        :param kwargs:
+        :return:
+        """
+        page_number = get_number_from_url(response.url)
+        try:
+            page = self._parse_page(response, page_number)
+            yield from self._add_page(response.meta['data'], page)
+        except Exception:
+            # The page is skipped like a failed download, so the book can still be finished
+            self.logger.exception(f'Failed to parse {response.url}')
+        yield from self._page_done(response.meta, page_number)
+
+    def page_failed(self, failure: Failure) -> Generator[dict[str, Any]]:
+        """
+        Skip a page that could not be downloaded, so the book can still be finished
+        :param failure:
+        :return:
+        """
+        # Scrapy sets the request of download errors on the failure
+        request: Request = failure.request  # type: ignore[attr-defined]
+        self.logger.error(f'Failed to download {request.url}: {failure.value!r}')
+        yield from self._page_done(request.meta, get_number_from_url(request.url))
+
+    def _parse_book_volumes(self, response: Response, data: dict[str, Any]) -> None:
+        """
+        Read the pages count and the volumes of the book from its first page
+        :param response: first page response
+        :param data: book data
+        :return:
+        """
+        data['info']['all_pages'] = int(
+            response.css(f'{Selectors.LAST_PAGE.value}::attr(href)').re_first(r'(\d+)#')
+        )
+        data['info']['volumes'] = {}
+        if parts := response.css(Selectors.PAGE_PARTS_MENU.value):
+            volumes = {}
+            for part in parts.css('li a')[1:]:
+                volumes[part.css('::text').get()] = int(
+                    part.css('::attr(href)').re_first(r'(\d+)#')
+                )
+            data['info']['volumes'] = self._get_start_end_pages(volumes, data['info']['all_pages'])
+        # Check if the required volume is valid
+        if self.vol and not response.css(f'{Selectors.PAGE_PARTS_MENU.value} li a::text')[1:].re(
+            self.vol
+        ):
+            raise ValueError(f'Volume {self.vol} not found in book {data["info"]["id"]}')
+
+    def _is_content_unchanged(self, response: Response, data: dict[str, Any]) -> bool:
+        """
+        Check whether the book content fingerprint matches the one of its last export
+        :param response: first page response
+        :param data: book data
+        :return: True if the book doesn't need to be crawled again
+        """
+        book_id = data['info']['id']
+        if book_id not in self.exported_content:
+            return False
+        fingerprint = content_fingerprint(
+            data['info']['all_pages'], self._parse_page(response, 1)['text']
+        )
+        if fingerprint != self.exported_content[book_id]:
+            return False
+        self.logger.info(f'Skipping book {book_id}, its content is unchanged')
+        self.stats.inc_value('book/skipped_unchanged')
+        return True
+
+    def _stored_pages(self, book_id: int) -> set[int]:
+        """
+        Get the page numbers of a book that are already in the page store when resuming
+        :param book_id: book ID
+        :return: set of page numbers
+        """
+        if not self.settings.getbool('RESUME_PAGES'):
+            return set()
+        if self.page_store is None:
+            self.page_store = PageStore(
+                self.settings.get('PAGE_STORE_PATH'), pragmas=sqlite_pragmas(self.settings)
             )
+        stored = self.page_store.page_numbers(book_id)
+        if stored:
+            self.logger.info(f'Resuming book {book_id}, {len(stored)} pages are already stored')
+        return stored
+
+    def _book_started(self, data: dict[str, Any], stored: set[int]) -> None:
+        """
+        Send the pages range of a book to the progress bar
+        :param data: book data
+        :param stored: stored page numbers
+        :return:
+        """
+        start, end = self._start_end_pages(data)
+        # The first page is already downloaded
+        done = sum(1 for n in stored if start <= n <= end) + (start == 1 and 1 not in stored)
+        self.crawler.signals.send_catch_log(
+            book_started,
+            book_id=data['info']['id'],
+            title=data['info']['title'],
+            start=start,
+            end=end,
+            done=done,
+            spider=self,
+        )
+
+    def _start_end_pages(self, data: dict[str, Any]) -> tuple[int, int]:
+        return page_range(data['info'], self.vol)
+
+    def _follow_missing_page(
+        self, data: dict[str, Any], stored: set[int], page_number: int
+    ) -> Generator[Any]:
+        """
+        Request the first page after page_number that isn't stored, or finish the book if there is none
+        :param data: book data
+        :param stored: stored page numbers
+        :param page_number: the page number to start after
+        :return:
+        """
+        end = self._start_end_pages(data)[1]
+        next_page = next((n for n in range(page_number + 1, end + 1) if n not in stored), None)
+        if next_page is None:
+            yield self._finish_book(data)
+            return
+        yield Request(
+            url=f'{self.site_url}/book/{data["info"]["id"]}/{next_page}',
+            callback=self.parse_book_text,
+            meta={'data': data, 'stored': stored},
+            priority=PAGE_PRIORITY,
+        )
+
+    def _fan_out_pages(
+        self, response: Response, data: dict[str, Any], stored: set[int]
+    ) -> Generator[Any]:
+        """
+        Request all the remaining pages of the book (or the required volume) at once
+        :param response: first page response
+        :param data: book data
+        :param stored: page numbers that are already stored
+        :return:
+        """
+        start, end = self._start_end_pages(data)
+        pending = set(range(start, end + 1)) - stored
+        if 1 in pending:
+            yield from self._add_page(data, self._parse_page(response, 1))
+            pending.discard(1)
+        if not pending:
+            yield self._finish_book(data)
+            return
+        meta = {'data': data, 'pending': pending}
+        for page_number in sorted(pending):
+            yield Request(
+                url=f'{self.site_url}/book/{data["info"]["id"]}/{page_number}',
+                callback=self.parse_book_page,
+                errback=self.page_failed,
+                meta=meta,
+                priority=PAGE_PRIORITY,
+            )
+
+    def _page_done(self, meta: dict[str, Any], page_number: int) -> Generator[dict[str, Any]]:
+        """
+        Mark a page as done and yield the book once all of its pages are done
+        :param meta: request meta shared by all pages of the book
+        :param page_number: the page number
+        :return:
+        """
+        pending: set[int] = meta['pending']
+        if page_number not in pending:
+            return
+        pending.discard(page_number)
+        if not pending:
+            data = meta['data']
+            if 'pages' in data:
+                data['pages'].sort(key=lambda page: page['page_number'])
+            yield self._finish_book(data)
+
+    @timed
+    def _parse_page(self, response: Response, page_number: int) -> dict[str, Any]:
+        """
+        Clean the text of a book page in a single pass over its tree, which is serialized once
+        :param response: page response
+        :param page_number: the page number
+        :return: dict of page number, printed page number and page text
+        """
+        page = int(response.css(f'{Selectors.PAGE_NUMBER.value}::attr(value)').get('0'))
+        content = response.css(Selectors.PAGE_CONTENT.value)[:1]
+        text = ''
+        if not content:
+            self.logger.warning(f'No page content in {response.url}')
+        else:
+            # Children are cleaned before their parents, so spans that only had dropped elements are empty
+            for element in reversed(list(content[0].root.iter('a', 'span'))):
+                if element.tag == 'a':
+                    if 'btn_tag' in element.get('class', '').split():
+                        element.drop_tree()  # Remove "Copy" button
+                # Delete empty spans
+                elif not self.HAS_TEXT(element):
+                    element.drop_tree()
+            # The first page can be parsed again for its content fingerprint, so the tree keeps the class
+            text = self.PARENT_DIV_CLASS_PATTERN.sub('', content.get())
+        return {
+            'page_number': page_number,
+            'page': page,
+            'text': text,
+            # 'html': response.css('.padding-top-20 .container').get()
+        }
+
+    def _add_page(self, data: dict[str, Any], page: dict[str, Any]) -> Generator[dict[str, Any]]:
+        """
+        Add a parsed page to the book data, or yield it as a page item when streaming pages
+        :param data: book data
+        :param page: parsed page
+        :return:
+        """
+        if self._streams_pages():
+            yield {'book_id': data['info']['id'], **page}
+        else:
+            data['pages'].append(page)
+
+    def _streams_pages(self) -> bool:
+        return self.settings.getbool('STREAM_PAGES') or self.settings.getbool('RESUME_PAGES')
+
+    def _finish_book(self, data: dict[str, Any]) -> dict[str, Any]:
+        """
+        Prepare the book data to be yielded after all of its pages are parsed
+        :param data: book data
+        :return: book data
+        """
+        if self.vol:
+            data = self._update_data_for_one_volume(data, data['info']['volumes'][self.vol])
+        # When streaming pages, the pages count is set by PageStorePipeline
+        if 'pages' in data:
+            data['info']['pages'] = len(data['pages'])
+        return data
 
     def _parse_toc(self, toc: SelectorList, seen: set | None = None) -> TocType:
         """
@@ -5,13 +5,14 @@ from scrapy.http import Response
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 
+from shamela.spiders import SiteMixin
 from shamela.utils import get_number_from_url
 
 
-class Books(CrawlSpider):
+class Books(SiteMixin, CrawlSpider):
     name = 'books'
     allowed_domains: ClassVar[list[str]] = ['shamela.ws']
-    start_urls: ClassVar[list[str]] = ['https://shamela.ws/']
+    start_path = '/'
 
     rules = (Rule(LinkExtractor(allow=r'category/'), callback='parse_item', follow=True),)
 
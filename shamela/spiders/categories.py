@@ -4,13 +4,14 @@ from typing import Any, ClassVar
 from scrapy import Spider
 from scrapy.http import Response
 
+from shamela.spiders import SiteMixin
 from shamela.utils import get_number_from_url
 
 
-class CategoriesSpider(Spider):
+class CategoriesSpider(SiteMixin, Spider):
     name = 'categories'
     allowed_domains: ClassVar[list[str]] = ['shamela.ws']
-    start_urls: ClassVar[list[str]] = ['https://shamela.ws/']
+    start_path = '/'
 
     def parse(
         self, response: Response, **kwargs: Any
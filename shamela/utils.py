@@ -1,2 +1,74 @@
+import heapq
+from bisect import bisect_right
+from hashlib import sha1
+
+
 def get_number_from_url(url: str) -> int:
     return int(url.split('/')[-1].split('#')[0])
+
+
+def parse_ids(ids: str) -> list[int]:
+    """
+    Parse a comma separated list of IDs and ID ranges, e.g. `1,5,10-20`
+    :param ids: IDs string
+    :return: sorted list of unique IDs
+    """
+    result: set[int] = set()
+    for part in filter(None, (i.strip() for i in ids.split(','))):
+        start, _, end = part.partition('-')
+        result.update(range(int(start), int(end or start) + 1))
+    return sorted(result)
+
+
+def content_fingerprint(all_pages: int, first_page_text: str) -> str:
+    """
+    Fingerprint a book by its pages count and the text of its first page
+    :param all_pages: the book pages count
+    :param first_page_text: the first page text
+    :return: hex digest
+    """
+    return sha1(f'{all_pages}:{first_page_text}'.encode(), usedforsecurity=False).hexdigest()
+
+
+class VolumeIndex:
+    """
+    Sorted interval index of the volumes of a book, from the start and end pages of
+    Book._get_start_end_pages, to find the volume of a page with a binary search
+    """
+
+    def __init__(self, volumes: dict[str, tuple[int, int]]) -> None:
+        """
+        :param volumes: dict mapping volume names to their (start_page, end_page)
+        """
+        intervals = sorted(
+            (start, index, end, name)
+            for index, (name, (start, end)) in enumerate(volumes.items())
+            if start <= end
+        )
+        boundaries = sorted(
+            {start for start, _, _, _ in intervals} | {end + 1 for _, _, end, _ in intervals}
+        )
+        # First page of each segment of the pages, with the volume of the segment. Where volumes
+        # overlap, the first one of the book is kept.
+        self._starts: list[int] = []
+        self._volumes: list[tuple[int, str] | None] = []
+        active: list[tuple[int, int, str]] = []
+        position = 0
+        for boundary in boundaries:
+            while position < len(intervals) and intervals[position][0] == boundary:
+                _, index, end, name = intervals[position]
+                heapq.heappush(active, (index, end, name))
+                position += 1
+            while active and active[0][1] < boundary:
+                heapq.heappop(active)
+            self._starts.append(boundary)
+            self._volumes.append((active[0][0], active[0][2]) if active else None)
+
+    def find(self, page_number: int) -> tuple[int, str] | None:
+        """
+        Find the volume of a page
+        :param page_number: page number in the book
+        :return: index and name of the volume, or None if the page is not in a volume
+        """
+        segment = bisect_right(self._starts, page_number) - 1
+        return self._volumes[segment] if segment >= 0 else None